@@ -5,3 +5,6 @@ for f in *.pdb; do
     mkdir -p "$dirname"
     mv "$f" "$dirname/"
 done
+
+# Register the folders in the shared variant manifest (variants.db).
+python3 "$(dirname "$0")/manifest.py" .
@@ -1,84 +1,471 @@
+import argparse
+import json
 import os
+import queue
+import re
 import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-base_dirs = [
-    './L-ASNase'
-]
+import manifest
+import profiling
+from leases import cooperative_map, lease_lost, stop_on_lease_lost
+
+# Folder that holds the Variant*_monomer directories.
+monomers_dir = './monomers'
+
+required_files = ["EM.mdp", "box_solv_ion.gro", "topol.top"]
+
+# Speculative retries start every attempt at once. Steepest descents is deterministic for a
+# given input, so each attempt gets a different step size to explore a different path.
+# None keeps the value from EM.mdp (attempt 1 is identical to the sequential rerun).
+attempt_emsteps = [None, 0.005, 0.002, 0.02]
+
+# --cooperative mode: a worker holds the lease of the variant it is minimizing, and records
+# the outcome together with the size/mtime of EM.log so no other worker repeats it.
+lease_file_name = ".minimization.lease"
+state_file_name = ".minimization_state.json"
+
+# The verdict is printed in the last lines of EM.log, so only the end of the file is read.
+log_tail_bytes = 64 * 1024
+
+# A run whose Fmax has not dropped by stall_improvement (relative) over stall_steps steps
+# is killed instead of being left to burn its whole nsteps budget. 0 disables the check.
+stall_steps = 5000
+stall_improvement = 0.01
+poll_interval = 1.0
 
 def check_log(log_path):
+    with profiling.span("check_log", variant=os.path.basename(os.path.dirname(os.path.abspath(log_path)))):
+        try:
+            with open(log_path, "rb") as f:
+                f.seek(0, os.SEEK_END)
+                f.seek(max(0, f.tell() - log_tail_bytes))
+                lines = f.read().decode(errors="ignore").splitlines()
+
+            for line in reversed(lines):
+                if "Steepest Descents converged to Fmax < 100" in line:
+                    return True
+                if "did not reach the requested Fmax < 100" in line:
+                    return False
+            return None
+        except FileNotFoundError:
+            print(f"[ERROR] File {log_path} not found.")
+            return None
+        except Exception as e:
+            print(f"[ERROR] Failed to read {log_path}: {str(e)}")
+            return None
+
+class LogWatcher:
+    """Follows the output of a running mdrun -v and judges the run from what has been written so far.
+
+    Only bytes appended since the previous poll are read. status is None while the run is
+    undecided, then "converged", "not-converged" or "stalled".
+    """
+
+    progress_re = re.compile(rb"Step=\s*(\d+),.*?Fmax=\s*([\d.eE+\-]+)")
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.partial = b""
+        self.status = None
+        self.best_fmax = None
+        self.best_step = 0
+        self.last_step = 0
+
+    def poll(self):
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(self.offset)
+                chunk = f.read()
+        except FileNotFoundError:
+            return self.status
+        self.offset += len(chunk)
+        # mdrun -v rewrites its progress line with carriage returns.
+        lines = re.split(rb"[\r\n]", self.partial + chunk)
+        self.partial = lines.pop()
+        for line in lines:
+            self.feed(line)
+        return self.status
+
+    def feed(self, line):
+        if b"converged to Fmax < 100" in line:
+            self.status = "converged"
+            return
+        if b"did not reach the requested Fmax < 100" in line:
+            self.status = "not-converged"
+            return
+        m = self.progress_re.search(line)
+        if not m or self.status is not None:
+            return
+        step, fmax = int(m.group(1)), float(m.group(2))
+        self.last_step = step
+        if self.best_fmax is None or fmax < self.best_fmax * (1 - stall_improvement):
+            self.best_fmax, self.best_step = fmax, step
+        elif stall_steps and step - self.best_step >= stall_steps:
+            self.status = "stalled"
+
+def find_variant_dirs(root):
+    if not os.path.isdir(root):
+        print(f"[ERROR] Directory '{root}' does not exist or is not valid.")
+        return []
+    return manifest.variant_dirs(root)
+
+def mdrun_options(threads, pinoffset):
+    # Each job gets its own block of cores so concurrent mdrun processes do not
+    # pin onto the same hardware threads. pinoffset=None leaves pinning to GROMACS.
+    options = ["-nt", str(threads)]
+    if pinoffset is None:
+        options += ["-pin", "auto"]
+    else:
+        options += ["-pin", "on", "-pinoffset", str(pinoffset), "-pinstride", "1"]
+    return options
+
+def run_gmx(args, base_dir, out_name):
+    # mdrun -v is chatty; with several jobs in flight the terminal would be unreadable,
+    # so every call writes to its own file inside the variant folder.
+    with open(os.path.join(base_dir, out_name), "a") as out:
+        profiling.run(["gmx"] + args, cwd=base_dir, stdout=out, stderr=subprocess.STDOUT, check=True,
+                      profile_fields={"name": f"gmx {args[0]}", "variant": os.path.basename(os.path.normpath(base_dir))})
+
+def start_mdrun(base_dir, deffnm, options):
+    out_path = os.path.join(base_dir, f"{deffnm}.out")
+    out = open(out_path, "a")
+    watcher = LogWatcher(out_path)
+    # Skip whatever earlier gmx calls (grompp) already wrote to the same file.
+    watcher.offset = os.path.getsize(out_path)
     try:
-        with open(log_path, "r") as f:
-            lines = f.readlines()
-
-        for line in reversed(lines):
-            if "Steepest Descents converged to Fmax < 100" in line:
-                return True
-            if "did not reach the requested Fmax < 100" in line:
-                return False
-        return None
-    except FileNotFoundError:
-        print(f"[ERROR] File {log_path} not found.")
-        return None
-    except Exception as e:
-        print(f"[ERROR] Failed to read {log_path}: {str(e)}")
-        return None
+        proc = profiling.popen(
+            ["gmx", "mdrun", "-v", "-deffnm", deffnm] + options,
+            {"name": "gmx mdrun", "variant": os.path.basename(os.path.normpath(base_dir)), "deffnm": deffnm},
+            cwd=base_dir, stdout=out, stderr=subprocess.STDOUT
+        )
+    except OSError:
+        out.close()
+        raise
+    stop_on_lease_lost(proc)
+    return proc, out, watcher
+
+def stop_mdrun(run):
+    proc, out, watcher = run
+    if profiling.poll(proc) is None:
+        proc.terminate()
+        # Polled rather than waited on, so a cancelled run is still accounted for.
+        deadline = time.monotonic() + 30
+        while profiling.poll(proc) is None:
+            if time.monotonic() > deadline:
+                proc.kill()
+                profiling.wait(proc)
+                break
+            time.sleep(0.1)
+    out.close()
+
+def wait_mdrun(run, label):
+    """Wait for one mdrun, killing it early if its Fmax stalls. Returns the watcher status."""
+    proc, out, watcher = run
+    while profiling.poll(proc) is None:
+        if watcher.poll() == "stalled":
+            print(f"[ERROR] {label} stalled at Fmax {watcher.best_fmax:g} "
+                  f"(no progress since step {watcher.best_step}); stopping it.")
+            break
+        time.sleep(poll_interval)
+    stop_mdrun(run)
+    if proc.returncode not in (0, None) and watcher.status != "stalled":
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    return watcher.poll()
 
-for base_dir in base_dirs:
+def minimize_variant(base_dir, threads, pinoffset, speculative=False):
+    name = os.path.basename(os.path.normpath(base_dir))
     print(f"\n📂 Processing directory: {base_dir}")
 
     if not os.path.isdir(base_dir):
         print(f"[ERROR] Directory '{base_dir}' does not exist or is not valid.")
-        continue
+        return "skipped"
 
-    required_files = ["EM.mdp", "box_solv_ion.gro", "topol.top"]
     missing_files = [f for f in required_files if not os.path.exists(os.path.join(base_dir, f))]
     if missing_files:
         print(f"[ERROR] Missing files in {base_dir}: {', '.join(missing_files)}. Skipping.")
-        continue
+        return "skipped"
 
     log_path = os.path.join(base_dir, "EM.log")
 
     if not os.path.exists(log_path):
         print(f"[WARNING] Directory {base_dir} does not contain EM.log")
-        continue
+        return "skipped"
 
     status = check_log(log_path)
 
     if status is True:
         print(f"[OK] Convergence reached (Fmax < 100) in {log_path}.")
-    elif status is False:
-        print(f"[ERROR] Did not converge in {log_path}. Trying to rerun minimization...")
-        
-        for i in range(1, 5):
-            tpr_file = f"EM_{i}.tpr"
-            log_file = f"EM_{i}.log"
-            print(f"[INFO] Attempt {i}: Running minimization for {tpr_file}...")
-            
-            try:
-                subprocess.run(
-                    f"gmx grompp -f EM.mdp -c box_solv_ion.gro -maxwarn 2 -p topol.top -o {tpr_file}",
-                    cwd=base_dir,
-                    shell=True,
-                    check=True
-                )
-                subprocess.run(
-                    f"gmx mdrun -v -deffnm EM_{i}",
-                    cwd=base_dir,
-                    shell=True,
-                    check=True
-                )
-                new_log_path = os.path.join(base_dir, log_file)
-                if os.path.exists(new_log_path):
-                    new_status = check_log(new_log_path)
-                    if new_status is True:
-                        print(f"[OK] Convergence reached (Fmax < 100) in {new_log_path} on attempt {i}.")
-                        break
-                    else:
-                        print(f"[ERROR] Attempt {i} did not converge in {new_log_path}.")
+        return "converged"
+    if status is None:
+        print(f"[WARNING] Could not interpret EM.log in {log_path}.")
+        return "skipped"
+
+    print(f"[ERROR] Did not converge in {log_path}. Trying to rerun minimization...")
+
+    if speculative:
+        return speculative_retries(base_dir, threads, pinoffset)
+
+    for i in range(1, 5):
+        tpr_file = f"EM_{i}.tpr"
+        log_file = f"EM_{i}.log"
+        print(f"[INFO] {name} attempt {i}: Running minimization for {tpr_file}...")
+
+        try:
+            run_gmx(
+                ["grompp", "-f", "EM.mdp", "-c", "box_solv_ion.gro", "-maxwarn", "2", "-p", "topol.top", "-o", tpr_file],
+                base_dir, f"EM_{i}.out"
+            )
+            run = start_mdrun(base_dir, f"EM_{i}", mdrun_options(threads, pinoffset))
+            if wait_mdrun(run, f"{name} attempt {i}") == "stalled":
+                continue
+            new_log_path = os.path.join(base_dir, log_file)
+            if os.path.exists(new_log_path):
+                new_status = check_log(new_log_path)
+                if new_status is True:
+                    print(f"[OK] Convergence reached (Fmax < 100) in {new_log_path} on attempt {i}.")
+                    return "rerun-converged"
                 else:
-                    print(f"[ERROR] File {log_file} was not generated on attempt {i}.")
-            except subprocess.CalledProcessError as e:
-                print(f"[ERROR] Minimization execution failed on attempt {i}: {str(e)}")
+                    print(f"[ERROR] Attempt {i} did not converge in {new_log_path}.")
+            else:
+                print(f"[ERROR] File {log_file} was not generated on attempt {i}.")
+        except (subprocess.CalledProcessError, OSError) as e:
+            print(f"[ERROR] Minimization execution failed on attempt {i} for {name}: {str(e)}")
+            return "failed"
+
+    return "not-converged"
+
+def write_attempt_mdp(base_dir, i, emstep):
+    if emstep is None:
+        return "EM.mdp"
+    with open(os.path.join(base_dir, "EM.mdp"), "r") as f:
+        lines = [line for line in f if line.split("=")[0].strip() != "emstep"]
+    lines.append(f"emstep = {emstep}\n")
+    mdp_file = f"EM_{i}.mdp"
+    with open(os.path.join(base_dir, mdp_file), "w") as f:
+        f.writelines(lines)
+    return mdp_file
+
+def attempt_files(base_dir, deffnm):
+    # Matches everything an attempt leaves behind, including GROMACS backups (#EM_2.log.1#).
+    pattern = re.compile(rf"^#?{re.escape(deffnm)}(?:_mdout)?\.")
+    return [f for f in os.listdir(base_dir) if pattern.match(f)]
+
+def promote_attempt(base_dir, winner, attempts):
+    """Keep the converged attempt as EM.* and delete the others, as 2-filter_minimization.py would."""
+    for i in attempts:
+        if i == winner:
+            continue
+        for fname in attempt_files(base_dir, f"EM_{i}"):
+            os.remove(os.path.join(base_dir, fname))
+    for fname in attempt_files(base_dir, "EM"):
+        if fname != "EM.mdp":
+            os.remove(os.path.join(base_dir, fname))
+    for fname in attempt_files(base_dir, f"EM_{winner}"):
+        ext = os.path.splitext(fname)[1]
+        if ext == ".mdp" or fname.startswith("#"):
+            os.remove(os.path.join(base_dir, fname))
+            continue
+        os.rename(os.path.join(base_dir, fname), os.path.join(base_dir, "EM" + ext))
+        print(f"✏️  Renamed: {fname}  →  EM{ext}")
+
+def discard_attempt_mdps(base_dir, attempts):
+    """Delete the .mdp files written for the attempts when none of them is promoted.
+
+    Left behind, EM_<i>.mdp would share the basename of replica EM_<i> and be renamed over
+    EM.mdp by 2-filter_minimization.py.
+    """
+    for i in attempts:
+        for fname in attempt_files(base_dir, f"EM_{i}"):
+            # Also catches GROMACS backups such as #EM_1_mdout.mdp.1#.
+            if ".mdp" in fname:
+                os.remove(os.path.join(base_dir, fname))
+
+def speculative_retries(base_dir, threads, pinoffset):
+    name = os.path.basename(os.path.normpath(base_dir))
+    attempts = list(range(1, len(attempt_emsteps) + 1))
+    # The job's cores are shared between the attempts running side by side.
+    per_attempt = max(1, threads // len(attempts))
+    pin = pinoffset is not None and per_attempt * len(attempts) <= threads
+
+    running = {}
+    try:
+        for i, emstep in zip(attempts, attempt_emsteps):
+            mdp_file = write_attempt_mdp(base_dir, i, emstep)
+            run_gmx(
+                ["grompp", "-f", mdp_file, "-c", "box_solv_ion.gro", "-maxwarn", "2", "-p", "topol.top",
+                 "-o", f"EM_{i}.tpr", "-po", f"EM_{i}_mdout.mdp"],
+                base_dir, f"EM_{i}.out"
+            )
+        for i in attempts:
+            offset = pinoffset + (i - 1) * per_attempt if pin else None
+            running[i] = start_mdrun(base_dir, f"EM_{i}", mdrun_options(per_attempt, offset))
+            print(f"[INFO] {name} attempt {i} started (emstep={attempt_emsteps[i - 1] or 'from EM.mdp'}).")
+    except (subprocess.CalledProcessError, OSError) as e:
+        print(f"[ERROR] Could not start speculative attempts for {name}: {str(e)}")
+        for run in running.values():
+            stop_mdrun(run)
+        discard_attempt_mdps(base_dir, attempts)
+        return "failed"
+
+    winner = None
+    while running and winner is None:
+        time.sleep(poll_interval)
+        for i, run in list(running.items()):
+            proc, out, watcher = run
+            status = watcher.poll()
+            if status in ("stalled", "not-converged"):
+                # No need to wait for nsteps to run out once the outcome is known.
+                print(f"[ERROR] {name} attempt {i} {status} (best Fmax {watcher.best_fmax}); stopping it.")
+                stop_mdrun(run)
+                del running[i]
+            elif profiling.poll(proc) is not None:
+                stop_mdrun(run)
+                del running[i]
+                if proc.returncode == 0 and check_log(os.path.join(base_dir, f"EM_{i}.log")) is True:
+                    winner = i
+                    print(f"[OK] {name} attempt {i} converged (Fmax < 100); cancelling {len(running)} other attempt(s).")
+                    break
+                print(f"[ERROR] {name} attempt {i} did not converge (exit code {proc.returncode}).")
+            elif status == "converged" and len(running) > 1:
+                # The winner is known; stop the others while it writes its final frame.
+                print(f"[INFO] {name} attempt {i} reports convergence; cancelling {len(running) - 1} other attempt(s).")
+                for j in [j for j in running if j != i]:
+                    stop_mdrun(running.pop(j))
                 break
+
+    for run in running.values():
+        stop_mdrun(run)
+
+    if winner is None:
+        discard_attempt_mdps(base_dir, attempts)
+        return "not-converged"
+    promote_attempt(base_dir, winner, attempts)
+    return "rerun-converged"
+
+def run_job(base_dir, submitted, slots, threads, pinning, speculative, first_core=0):
+    slot = slots.get()
+    started = time.monotonic()
+    try:
+        pinoffset = first_core + slot * threads if pinning else None
+        with profiling.span("minimize_variant", variant=os.path.basename(os.path.normpath(base_dir)),
+                            queued_s=round(started - submitted, 3)):
+            status = minimize_variant(base_dir, threads, pinoffset, speculative)
+    except Exception as e:
+        print(f"[ERROR] Unexpected failure in {base_dir}: {str(e)}")
+        status = "failed"
+    finally:
+        slots.put(slot)
+    return status, started - submitted, time.monotonic() - started
+
+def em_log_signature(base_dir):
+    try:
+        st = os.stat(os.path.join(base_dir, "EM.log"))
+    except FileNotFoundError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+def record_outcome(base_dir, status):
+    path = os.path.join(base_dir, state_file_name)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"status": status, "em_log": em_log_signature(base_dir)}, f)
+    os.replace(tmp_path, path)
+
+def is_handled(base_dir):
+    """True once a worker has processed the current EM.log of this variant."""
+    try:
+        with open(os.path.join(base_dir, state_file_name), "r") as f:
+            return json.load(f).get("em_log") == em_log_signature(base_dir)
+    except (FileNotFoundError, ValueError):
+        return False
+
+def plan_slots(jobs, threads, first_core=0):
+    cores = max(1, (os.cpu_count() or 1) - first_core)
+    if jobs is None and threads is None:
+        threads = min(4, cores)
+    if jobs is None:
+        jobs = max(1, cores // threads)
+    if threads is None:
+        threads = max(1, cores // jobs)
+    pinning = jobs * threads <= cores
+    if not pinning:
+        print(f"[WARNING] {jobs} jobs x {threads} threads exceeds {cores} cores; mdrun pinning disabled.")
+    return jobs, threads, pinning
+
+def run_pool(base_dirs, work, jobs):
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(work, d): d for d in base_dirs}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+def main():
+    global stall_steps
+    parser = argparse.ArgumentParser(description="Re-run non-converged energy minimizations for every variant.")
+    parser.add_argument("dirs", nargs="*", help="Variant folders to process (default: every Variant*_monomer in --monomers-dir).")
+    parser.add_argument("--monomers-dir", default=monomers_dir)
+    parser.add_argument("-j", "--jobs", type=int, help="Number of minimization jobs run at the same time.")
+    parser.add_argument("-t", "--threads-per-job", type=int, help="mdrun threads (-nt) given to each job.")
+    parser.add_argument("--stall-steps", type=int, default=stall_steps,
+                        help="Stop an mdrun whose Fmax has not improved for this many steps (0 disables).")
+    parser.add_argument("--speculative", action="store_true",
+                        help="Start all retry attempts at once, keep the first one that converges and prune the rest.")
+    parser.add_argument("--cooperative", action="store_true",
+                        help="Share the variants with other workers (any host) through lease files.")
+    parser.add_argument("--pinoffset", type=int, default=0,
+                        help="First core used for pinning; lets several invocations share a node without overlapping.")
+    args = parser.parse_args()
+    stall_steps = args.stall_steps
+
+    base_dirs = args.dirs or find_variant_dirs(args.monomers_dir)
+    if not base_dirs:
+        print("[ERROR] No variant folders to process.")
+        return 1
+
+    jobs, threads, pinning = plan_slots(args.jobs, args.threads_per_job, args.pinoffset)
+    if args.cooperative and pinning:
+        # Other workers on this host pin from core 0 too; let GROMACS place the threads.
+        print("[INFO] Cooperative mode: mdrun pinning disabled.")
+        pinning = False
+    print(f"[INFO] {len(base_dirs)} variants, {jobs} concurrent jobs x {threads} threads each.")
+
+    slots = queue.Queue()
+    for slot in range(jobs):
+        slots.put(slot)
+
+    submitted = time.monotonic()
+
+    def work(base_dir):
+        result = run_job(base_dir, submitted, slots, threads, pinning, args.speculative, args.pinoffset)
+        # A worker whose lease was taken over leaves the outcome to the new holder.
+        if args.cooperative and not lease_lost():
+            record_outcome(base_dir, result[0])
+        return result
+
+    if args.cooperative:
+        completed = cooperative_map(base_dirs, lambda d: os.path.join(d, lease_file_name), is_handled, work, jobs)
     else:
-        print(f"[WARNING] Could not interpret EM.log in {log_path}.")
+        completed = run_pool(base_dirs, work, jobs)
+
+    results = {}
+    for base_dir, (status, waited, ran) in completed:
+        results[base_dir] = (status, waited, ran)
+        print(f"[DONE] {os.path.basename(os.path.normpath(base_dir))}: {status} (queued {waited:.1f} s, ran {ran:.1f} s)")
+
+    print("\n⏱️  Job summary:")
+    print(f"{'Variant':<40} {'Status':<16} {'Queued (s)':>10} {'Run (s)':>10}")
+    for base_dir in base_dirs:
+        if base_dir not in results:
+            continue
+        status, waited, ran = results[base_dir]
+        print(f"{os.path.basename(os.path.normpath(base_dir)):<40} {status:<16} {waited:>10.1f} {ran:>10.1f}")
+
+    return 1 if any(status == "failed" for status, _, _ in results.values()) else 0
+
+if __name__ == "__main__":
+    with profiling.stage("1-minimization"):
+        exit_code = main()
+    sys.exit(exit_code)
@@ -1,79 +1,163 @@
+import argparse
+import json
+import mmap
 import os
 import re
 
+import manifest
+import profiling
+
 base_dir = "."
 
-regex_force = re.compile(r"Maximum force\s*=\s*([\d\.Ee\+\-]+)")
+regex_force = re.compile(rb"Maximum force\s*=\s*([\d\.Ee\+\-]+)")
+
+# Fmax extracted from every EM*.log, keyed by path and checked against size and mtime,
+# so later runs only parse logs that are new or have changed. Kept inside base_dir.
+index_name = ".fmax_index.json"
 
-global_status_path = os.path.join(base_dir, "replicated_status.txt")
-with open(global_status_path, "w") as g:
-    g.write("General summary of replicas:\n\n")
+def load_index(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
 
-for dir_name in sorted(os.listdir(base_dir)):
-    variant_dir = os.path.join(base_dir, dir_name)
-    if not (os.path.isdir(variant_dir) and dir_name.startswith("Variant") and dir_name.endswith("_monomer")):
-        continue
+def save_index(path, index):
+    # Several single-variant runs may save at once; each writes its own temporary file.
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, path)
 
-    print(f"\n📂 Processing: {dir_name}")
+def extract_fmax(log_path):
+    # The log is memory-mapped and searched in place instead of being read into a string.
+    with open(log_path, "rb") as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                m = regex_force.search(mm)
+                return float(m.group(1)) if m else None
+        except ValueError:
+            # Empty files cannot be mapped.
+            return None
 
-    forces = {}
-    log_files = [f for f in os.listdir(variant_dir) if f.startswith("EM") and f.endswith(".log") and f != "EM.mdp"]
+def cached_fmax(index, log_path, stat):
+    entry = index.get(log_path)
+    if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+        return entry["fmax"], False
+    with profiling.span("extract_fmax", variant=os.path.basename(os.path.dirname(os.path.abspath(log_path)))):
+        fmax = extract_fmax(log_path)
+    index[log_path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "fmax": fmax}
+    return fmax, True
 
-    for log_file in log_files:
-        log_path = os.path.join(variant_dir, log_file)
-        with open(log_path, "r", errors="ignore") as f:
-            content = f.read()
-        m = regex_force.search(content)
-        if m:
-            base_no_ext = os.path.splitext(log_file)[0]
-            forces[base_no_ext] = float(m.group(1))
+def main():
+    parser = argparse.ArgumentParser(description="Keep the best minimization replica of every variant.")
+    parser.add_argument("dirs", nargs="*", help="Variant folders to process (default: every Variant*_monomer in --base-dir).")
+    parser.add_argument("--base-dir", default=base_dir,
+                        help="Folder holding the variants, the Fmax index and replicated_status.txt.")
+    args = parser.parse_args()
 
-    if not forces:
-        print("⚠️  No EM*.log containing 'Maximum force' found. Skipping folder.")
-        continue
+    index_path = os.path.join(args.base_dir, index_name)
+    index = load_index(index_path)
+    seen_logs = set()
+    parsed_logs = 0
+    variant_dirs = args.dirs or manifest.variant_dirs(args.base_dir)
 
-    sorted_forces = sorted(forces.items(), key=lambda x: x[1])
-    best_base, best_f = sorted_forces[0]
+    global_status_path = os.path.join(args.base_dir, "replicated_status.txt")
+    if not args.dirs or not os.path.exists(global_status_path):
+        with open(global_status_path, "w") as g:
+            g.write("General summary of replicas:\n\n")
 
-    summary_path = os.path.join(variant_dir, "forces_summary.txt")
-    with open(summary_path, "w") as out:
-        out.write("Summary of maximum forces (kJ/mol/nm):\n\n")
-        for base, val in sorted_forces:
-            out.write(f"{base}.log: {val:.4f}\n")
-        out.write(f"\nBest replica: {best_base}.log  (Maximum force = {best_f:.4f} kJ/mol/nm)\n")
+    for variant_dir in variant_dirs:
+        dir_name = os.path.basename(os.path.normpath(variant_dir))
 
-    print(f"📝 Summary saved in: {summary_path}")
-    print(f"✅ Best replica: {best_base}.log (Fmax={best_f:.2f})")
+        print(f"\n📂 Processing: {dir_name}")
 
-    with open(global_status_path, "a") as g:
-        g.write(f"📂 {dir_name}\n")
-        g.write(f"   📝 Summary saved in: {summary_path}\n")
-        g.write(f"   ✅ Best replica: {best_base}.log (Fmax={best_f:.2f})\n\n")
+        forces = {}
+        # One listing per folder; the pruning below works from the same entries.
+        entries = {e.name: e for e in os.scandir(variant_dir) if e.is_file()}
+        log_files = [f for f in entries if f.startswith("EM") and f.endswith(".log") and f != "EM.mdp"]
 
-    em_pattern_files = [f for f in os.listdir(variant_dir) if re.match(r"^EM(?:_\d+)?\..+$", f)]
-    for fname in em_pattern_files:
-        if fname == "EM.mdp":
+        for log_file in log_files:
+            log_path = os.path.join(variant_dir, log_file)
+            seen_logs.add(log_path)
+            fmax, parsed = cached_fmax(index, log_path, entries[log_file].stat())
+            parsed_logs += parsed
+            if fmax is not None:
+                base_no_ext = os.path.splitext(log_file)[0]
+                forces[base_no_ext] = fmax
+
+        if not forces:
+            print("⚠️  No EM*.log containing 'Maximum force' found. Skipping folder.")
             continue
-        base_no_ext = os.path.splitext(fname)[0]
-        if base_no_ext != best_base:
-            try:
-                os.remove(os.path.join(variant_dir, fname))
-                print(f"🗑️  Removed: {fname}")
-            except FileNotFoundError:
-                pass
-
-    if best_base != "EM":
-        chosen_files = [f for f in os.listdir(variant_dir) if os.path.splitext(f)[0] == best_base]
-        for fname in chosen_files:
+
+        sorted_forces = sorted(forces.items(), key=lambda x: x[1])
+        best_base, best_f = sorted_forces[0]
+
+        summary_path = os.path.join(variant_dir, "forces_summary.txt")
+        with open(summary_path, "w") as out:
+            out.write("Summary of maximum forces (kJ/mol/nm):\n\n")
+            for base, val in sorted_forces:
+                out.write(f"{base}.log: {val:.4f}\n")
+            out.write(f"\nBest replica: {best_base}.log  (Maximum force = {best_f:.4f} kJ/mol/nm)\n")
+
+        print(f"📝 Summary saved in: {summary_path}")
+        print(f"✅ Best replica: {best_base}.log (Fmax={best_f:.2f})")
+
+        with open(global_status_path, "a") as g:
+            g.write(f"📂 {dir_name}\n")
+            g.write(f"   📝 Summary saved in: {summary_path}\n")
+            g.write(f"   ✅ Best replica: {best_base}.log (Fmax={best_f:.2f})\n\n")
+
+        em_pattern_files = [f for f in entries if re.match(r"^EM(?:_\d+)?\..+$", f)]
+        for fname in em_pattern_files:
             if fname == "EM.mdp":
                 continue
-            old_path = os.path.join(variant_dir, fname)
-            ext = os.path.splitext(fname)[1]
-            new_path = os.path.join(variant_dir, "EM" + ext)
-            if os.path.exists(new_path):
-                os.remove(new_path)
-            os.rename(old_path, new_path)
-            print(f"✏️  Renamed: {fname}  →  EM{ext}")
-
-print("\n🎉 Done! All Variant folders have been processed.")
-print(f"📑 Global summary saved in: {global_status_path}")
+            base_no_ext = os.path.splitext(fname)[0]
+            if base_no_ext != best_base:
+                try:
+                    os.remove(os.path.join(variant_dir, fname))
+                    print(f"🗑️  Removed: {fname}")
+                except FileNotFoundError:
+                    pass
+                del entries[fname]
+
+        if best_base != "EM":
+            chosen_files = [f for f in entries if os.path.splitext(f)[0] == best_base]
+            for fname in chosen_files:
+                # Parameter files are inputs, not replica outputs; EM.mdp stays the campaign's.
+                if fname.endswith(".mdp"):
+                    continue
+                old_path = os.path.join(variant_dir, fname)
+                ext = os.path.splitext(fname)[1]
+                new_path = os.path.join(variant_dir, "EM" + ext)
+                if os.path.exists(new_path):
+                    os.remove(new_path)
+                os.rename(old_path, new_path)
+                print(f"✏️  Renamed: {fname}  →  EM{ext}")
+                if ext == ".log":
+                    # A rename keeps size and mtime, so the cached Fmax still applies.
+                    index[new_path] = index.pop(old_path)
+                    seen_logs.add(new_path)
+
+        manifest.update(variant_dir, fmax=best_f, best_replica=best_base)
+        manifest.record_artifacts(variant_dir, [os.path.join(variant_dir, f) for f in ("EM.log", "EM.gro")])
+
+    # Merge into the index as it is on disk now: single-variant runs of the pipeline save it
+    # concurrently, and each must keep what the others added meanwhile. Entries for logs that
+    # were pruned or no longer exist are dropped; those of variants not processed here are
+    # kept as they are.
+    processed = tuple(os.path.join(d, "") for d in variant_dirs)
+    index = dict(load_index(index_path), **{path: index[path] for path in seen_logs if path in index})
+    index = {
+        path: entry for path, entry in index.items()
+        if os.path.exists(path) and (path in seen_logs or not path.startswith(processed))
+    }
+    save_index(index_path, index)
+
+    print("\n🎉 Done! All Variant folders have been processed.")
+    print(f"📑 Global summary saved in: {global_status_path}")
+    print(f"🔎 Parsed {parsed_logs} new or changed log(s); {len(index)} cached in {index_path}")
+
+if __name__ == "__main__":
+    with profiling.stage("2-filter_minimization"):
+        main()
@@ -1,97 +1,22 @@
+import argparse
 import os
-from pymol import cmd
 
-monomers_dir = "./monomers"
-
-cmd.reinitialize()
-cmd.load("6v2a_monomer.pdb")
-
-folders = [
-    d for d in os.listdir(monomers_dir)
-    if os.path.isdir(os.path.join(monomers_dir, d))
-    and d.startswith("Variant")
-    and d.endswith("_monomer")
-]
-
-for folder in folders:
-    variant = folder.split("Variant")[1].split("_monomer")[0]
-    full_folder = os.path.join(monomers_dir, folder)
-    model_name = f"EM_Variant{variant}_monomer"
-    pdb_path = os.path.join(full_folder, f"EM_Variant{variant}_monomer.pdb")
-
-    if not os.path.exists(pdb_path):
-        print(f"PDB file not found in {full_folder}: {pdb_path}")
-        continue
-
-    cmd.load(pdb_path, model_name)
-
-    try:
-        rmsd = cmd.align("6v2a_monomer", model_name)[0]
-        print(f"Alignment RMSD for {variant}: {rmsd:.3f}")
-    except:
-        print(f"Alignment error for {variant}. Skipping...")
-        cmd.delete(model_name)
-        continue
-
-    cmd.remove("resn HOH")
-    cmd.remove("resn WAT")
-
-    cmd.select("lig", "hetatm and chain A and resn ASN and resi 401")
-    lig_atoms = cmd.count_atoms("lig")
-    print(f"Atom count in 'lig' for {variant}: {lig_atoms}")
-
-    if lig_atoms == 0:
-        print(f"Error: Ligand ASN 401 (chain A) not found for {variant}.")
-        cmd.delete(model_name)
-        continue
-
-    cmd.show("sticks", "lig")
-
-    cmd.select("pocket_6v2a", "byres (polymer within 5.0 of lig)")
-    print(f"pocket_6v2a selection for {variant}: {cmd.count_atoms('pocket_6v2a')} atoms")
+import numpy as np
 
-    cmd.select("pocket_model", f"{model_name} within 5.0 of pocket_6v2a")
-    print(f"pocket_model selection for {variant}: {cmd.count_atoms('pocket_model')} atoms")
+import manifest
+import profiling
+from pocket_geometry import find_pocket, load_reference
+from pocket_render import render_all, render_modes
+from structure_cache import load_structure
 
-    cmd.select("near_model", "byres (polymer and pocket_model)")
-    print(f"near_model selection for {variant}: {cmd.count_atoms('near_model')} atoms")
-
-    atoms = cmd.get_model("near_model and name CA").atom
-
-    if not atoms:
-        print(f"No CA atoms found in 'near_model' selection for {variant}.")
-        cmd.delete(model_name)
-        cmd.delete("lig")
-        cmd.delete("pocket_6v2a")
-        cmd.delete("pocket_model")
-        cmd.delete("near_model")
-        continue
-
-    x = sum(a.coord[0] for a in atoms) / len(atoms)
-    y = sum(a.coord[1] for a in atoms) / len(atoms)
-    z = sum(a.coord[2] for a in atoms) / len(atoms)
-    print(f"Centroid (X, Y, Z) for {variant}: ({x}, {y}, {z})")
-
-    cmd.pseudoatom("centroid_pocket", pos=[x, y, z])
-    cmd.show("spheres", "centroid_pocket")
-    cmd.color("red", "centroid_pocket")
-    cmd.set("sphere_scale", 1.0, "centroid_pocket")
-
-    cmd.select("pocket_residues", f"(byres ({model_name} within 8 of centroid_pocket) and polymer.protein)")
-
-    cmd.show("cartoon", model_name)
-    cmd.color("slate", f"{model_name} and not lig")
-
-    cmd.show("cartoon", "6v2a_monomer")
-    cmd.color("wheat", "6v2a_monomer and not lig")
-
-    cmd.zoom("centroid_pocket", buffer=15)
+monomers_dir = "./monomers"
+reference_pdb = "6v2a_monomer.pdb"
+# Parsed reference, ligand and pocket are stored in this folder next to the reference PDB,
+# keyed by a hash of its contents.
+reference_cache_dir = ".reference_cache"
 
-    residues = []
-    for a in cmd.get_model("pocket_residues and name CA").atom:
-        residues.append((a.resi, a.resn, a.coord[0], a.coord[1], a.coord[2]))
+def write_outputs(full_folder, x, y, z, residues):
     n_residues = len(residues)
-
     coordinates_path = os.path.join(full_folder, "coordinates.txt")
 
     with open(coordinates_path, "w") as f:
@@ -117,27 +42,84 @@ for folder in folders:
         f.write("> <Gold.Protein.ActiveResidues>\n")
         f.write(" ".join(residues_unique) + "\n")
 
-    cmd.bg_color("white")
-    cmd.set("ray_trace_mode", 1)
-    cmd.set("antialias", 2)
-    cmd.set("ray_shadows", 0)
-    cmd.set("ray_trace_gain", 0.1)
-    cmd.set("ray_trace_disco_factor", 1)
-    cmd.set("ray_trace_fog", 0.5)
-
-    cmd.color("yellow", "lig")
-    cmd.rebuild()
-    cmd.refresh()
-
-    image_path = os.path.join(full_folder, "centroid_pocket.png")
-    cmd.png(image_path, width=2000, height=1800, dpi=300, ray=0)
-    print(f"Image 'centroid_pocket.png' saved successfully for {variant} in {full_folder}!\n")
-    print("=" * 20)
-
-    cmd.delete(model_name)
-    cmd.delete("lig")
-    cmd.delete("pocket_6v2a")
-    cmd.delete("pocket_model")
-    cmd.delete("near_model")
-    cmd.delete("centroid_pocket")
-    cmd.delete("pocket_residues")
+def main():
+    parser = argparse.ArgumentParser(description="Find the active-site pocket centroid of every variant.")
+    parser.add_argument("dirs", nargs="*", help="Variant folders to process (default: every Variant*_monomer in --monomers-dir).")
+    parser.add_argument("--monomers-dir", default=monomers_dir)
+    parser.add_argument("--reference", default=reference_pdb, help="Reference PDB holding the ASN 401 ligand.")
+    parser.add_argument("--images", choices=sorted(render_modes) + ["none"], default="full",
+                        help="Render full-size images, thumbnails only, or no images at all.")
+    parser.add_argument("--render-workers", type=int, help="PyMOL worker processes for rendering (default: all cores).")
+    args = parser.parse_args()
+
+    if args.images != "none":
+        try:
+            import pymol2  # noqa: F401
+        except ImportError:
+            print("PyMOL is not available; centroid_pocket images will not be generated.")
+            args.images = "none"
+
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(args.reference)), reference_cache_dir)
+    reference, lig_mask, ref_pocket = load_reference(args.reference, cache_dir,
+                                                     chain="A", resn="ASN", resi="401")
+    lig_atoms = int(lig_mask.sum())
+    print(f"Atom count in 'lig': {lig_atoms}")
+
+    if lig_atoms == 0:
+        print("Error: Ligand ASN 401 (chain A) not found in the reference.")
+        return
+    print(f"pocket_6v2a selection in the reference: {int(ref_pocket.sum())} atoms")
+
+    if args.dirs:
+        folders = [os.path.normpath(d) for d in args.dirs]
+    else:
+        folders = manifest.variant_dirs(args.monomers_dir)
+
+    render_jobs = []
+    for full_folder in folders:
+        folder = os.path.basename(full_folder)
+        variant = folder.split("Variant")[1].split("_monomer")[0]
+        model_name = f"EM_Variant{variant}_monomer"
+        pdb_path = os.path.join(full_folder, f"EM_Variant{variant}_monomer.pdb")
+
+        if not os.path.exists(pdb_path):
+            print(f"PDB file not found in {full_folder}: {pdb_path}")
+            continue
+
+        with profiling.span("load_pdb", variant=folder):
+            model = load_structure(pdb_path)
+
+        try:
+            with profiling.span("find_pocket", variant=folder):
+                pocket = find_pocket(reference, model, lig_mask, ref_pocket)
+            print(f"Alignment RMSD for {variant}: {pocket['rmsd']:.3f}")
+        except (ValueError, np.linalg.LinAlgError):
+            print(f"Alignment error for {variant}. Skipping...")
+            continue
+
+        print(f"pocket_6v2a selection for {variant}: {pocket['pocket_atoms']} atoms (reference + model)")
+        print(f"pocket_model selection for {variant}: {pocket['pocket_model_atoms']} atoms")
+        print(f"near_model selection for {variant}: {pocket['near_model_atoms']} atoms")
+
+        if pocket["centroid"] is None:
+            print(f"No CA atoms found in 'near_model' selection for {variant}.")
+            continue
+
+        x, y, z = pocket["centroid"]
+        print(f"Centroid (X, Y, Z) for {variant}: ({x}, {y}, {z})")
+
+        write_outputs(full_folder, x, y, z, pocket["residues"])
+        manifest.update(full_folder, centroid_x=float(x), centroid_y=float(y), centroid_z=float(z))
+        manifest.record_artifacts(full_folder, [os.path.join(full_folder, f)
+                                                for f in ("coordinates.txt", "gold_activesite_aas.txt")])
+
+        render_jobs.append((pdb_path, model_name, pocket["centroid"].tolist()))
+        print("=" * 20)
+
+    # Images are drawn after every centroid is written, by a separate pool of PyMOL workers.
+    with profiling.span("render_all", images=len(render_jobs)):
+        render_all(render_jobs, args.images, args.render_workers, args.reference)
+
+if __name__ == "__main__":
+    with profiling.stage("3-find_centroid"):
+        main()
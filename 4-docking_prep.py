@@ -1,101 +1,268 @@
+import argparse
+import hashlib
+import json
 import os
-import shutil
 import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
-def run_gold_batch_setup():
-    current_directory = os.getcwd()
-    monomers_dir = os.path.join(current_directory, 'monomers')
+import manifest
+import profiling
+from gold_conf import GoldConf, GoldConfError, ligand_stem, shard_conf_name
+from proc_stream import run_logged
 
-    source_conf = 'gold.conf'
-    # Edit the line below to include the path where your software is installed.
-    gold_utils_path = "/home/your_pc_name/CCDC/ccdc-software/gold/GOLD/gold_utils"
+source_conf = 'gold.conf'
+centroid_file_name = 'gold_activesite_aas.txt'
+# Optional per-variant gold.conf settings, e.g.
+# {"*": {"popsiz": 100}, "Variant12_monomer": {"ga_runs": 20, "ligand_data_file": [["L-Asn.mol2", 20]]}}
+overrides_file = 'gold_overrides.json'
+# Content hashes of the inputs used for the last successful setup of a variant.
+build_cache_name = '.prep_cache.json'
+# gold_utils output is streamed to this file in each variant folder.
+protonation_log_name = 'gold_utils.log'
+# Edit the line below to include the path where your software is installed.
+gold_utils_path = "/home/your_pc_name/CCDC/ccdc-software/gold/GOLD/gold_utils"
 
-    for variant_name in os.listdir(monomers_dir):
-        if variant_name.startswith('Variant') and variant_name.endswith('_monomer'):
-            variant_id = variant_name.split("Variant")[1].split("_monomer")[0]
-            variant_folder = os.path.join(monomers_dir, variant_name)
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
 
-            centroid_file_name = 'gold_activesite_aas.txt'
-            destination_conf = os.path.join(variant_folder, source_conf)
+def input_hashes(template_conf, overrides, input_pdb_path, centroid_file_path, shard=False):
+    hashes = {}
+    for key, path in (('gold_conf', template_conf), ('input_pdb', input_pdb_path), ('active_site', centroid_file_path)):
+        hashes[key] = file_hash(path) if os.path.exists(path) else None
+    hashes['overrides'] = hashlib.sha256(json.dumps(overrides, sort_keys=True).encode()).hexdigest()
+    hashes['shard_ligands'] = shard
+    return hashes
 
-            try:
-                shutil.copyfile(os.path.join(current_directory, source_conf), destination_conf)
-                print(f"gold.conf copied to: {variant_folder}")
-            except FileNotFoundError:
-                print(f"Error: '{source_conf}' not found in: {current_directory}")
-                continue
+def load_overrides(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
 
-            input_pdb = f"EM_Variant{variant_id}_monomer.pdb"
-            output_pdb = f"EM_Variant{variant_id}_monomer_H.pdb"
-            input_pdb_path = os.path.join(variant_folder, input_pdb)
-            output_pdb_path = os.path.join(variant_folder, output_pdb)
+def variant_overrides(all_overrides, variant_name):
+    overrides = dict(all_overrides.get('*', {}))
+    overrides.update(all_overrides.get(variant_name, {}))
+    return overrides
 
-            if not os.path.exists(input_pdb_path):
-                print(f"Error: Input file '{input_pdb}' not found in: {variant_folder}")
-                continue
+def load_build_cache(variant_folder):
+    try:
+        with open(os.path.join(variant_folder, build_cache_name), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
 
-            if os.path.exists(output_pdb_path):
-                print(f"Warning: Output file '{output_pdb_path}' already exists. Removing...")
-                os.remove(output_pdb_path)
+def save_build_cache(variant_folder, record):
+    path = os.path.join(variant_folder, build_cache_name)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(record, f, indent=1)
+    os.replace(path + '.tmp', path)
 
-            gold_utils_cmd = [
-                gold_utils_path,
-                "-protonate",
-                "-i", input_pdb_path,
-                "-o", output_pdb_path
-            ]
+def is_up_to_date(variant_folder, hashes, destination_conf, output_pdb_path):
+    record = load_build_cache(variant_folder)
+    if record is None or record.get('inputs') != hashes:
+        return False
+    if not (os.path.exists(output_pdb_path) and os.path.exists(destination_conf)):
+        return False
+    # A hand-edited conf is regenerated rather than trusted.
+    if file_hash(destination_conf) != record.get('gold_conf_out'):
+        return False
+    for name, digest in record.get('shard_confs_out', {}).items():
+        path = os.path.join(variant_folder, name)
+        if not os.path.exists(path) or file_hash(path) != digest:
+            return False
+    return True
 
-            try:
-                result = subprocess.run(gold_utils_cmd, capture_output=True, text=True, check=True)
-                print(f"Protonation completed for {variant_name}: {output_pdb_path}")
-                print(f"gold_utils output: {result.stdout}")
-                if result.stderr:
-                    print(f"gold_utils warnings/errors: {result.stderr}")
-            except subprocess.CalledProcessError as e:
-                print(f"Error running gold_utils for {variant_name}: {e}")
-                print(f"Error output: {e.stderr}")
-                continue
-            except FileNotFoundError:
-                print(f"Error: '{gold_utils_path}' not found.")
-                continue
+def write_shard_confs(template, overrides, variant_folder, ligands, previous):
+    """One conf per ligand, sharing the protonated protein and cavity of gold.conf.
 
-            centroid_file_path = os.path.join(variant_folder, centroid_file_name)
-            if not os.path.exists(centroid_file_path):
-                print(f"Error: '{centroid_file_name}' not found in: {variant_folder}")
-                continue
+    Shards written by an earlier run that are no longer wanted are removed, so that
+    5-docking.py goes back to docking the whole ligand set in one run.
+    """
+    written = {}
+    for ligand in ligands:
+        name = shard_conf_name(ligand_stem(ligand[0]))
+        path = os.path.join(variant_folder, name)
+        template.write(path, dict(overrides, ligand_data_file=[ligand]))
+        written[name] = file_hash(path)
+    for name in previous:
+        if name not in written and os.path.exists(os.path.join(variant_folder, name)):
+            os.remove(os.path.join(variant_folder, name))
+    return written
 
-            try:
-                with open(destination_conf, 'r') as f:
-                    conf_lines = f.readlines()
+def prepare_variant(template, overrides, variant_name, variant_folder, variant_id, hashes):
+    destination_conf = os.path.join(variant_folder, source_conf)
+
+    input_pdb = f"EM_Variant{variant_id}_monomer.pdb"
+    output_pdb = f"EM_Variant{variant_id}_monomer_H.pdb"
+    input_pdb_path = os.path.join(variant_folder, input_pdb)
+    output_pdb_path = os.path.join(variant_folder, output_pdb)
+
+    if not os.path.exists(input_pdb_path):
+        print(f"Error: Input file '{input_pdb}' not found in: {variant_folder}")
+        return False
+
+    # Ligand paths in gold.conf are relative to the variant folder, where gold_auto runs.
+    _, ligands = template.merged(dict(overrides, cavity_file=centroid_file_name, protein_datafile=output_pdb_path))
+    missing = [name for name, _ in ligands if not os.path.exists(os.path.join(variant_folder, name))]
+    if missing:
+        print(f"Error: ligand file(s) {', '.join(missing)} not found in: {variant_folder}")
+        return False
+
+    if os.path.exists(output_pdb_path):
+        print(f"Warning: Output file '{output_pdb_path}' already exists. Removing...")
+        os.remove(output_pdb_path)
+
+    gold_utils_cmd = [
+        gold_utils_path,
+        "-protonate",
+        "-i", input_pdb_path,
+        "-o", output_pdb_path
+    ]
 
-                new_conf_lines = []
-                protein_datafile_updated = False
-                cavity_file_updated = False
+    try:
+        log_path = os.path.join(variant_folder, protonation_log_name)
+        run_logged(gold_utils_cmd, log_path)
+        print(f"Protonation completed for {variant_name}: {output_pdb_path}")
+        print(f"gold_utils output saved in: {log_path}")
+    except subprocess.CalledProcessError as e:
+        print(f"Error running gold_utils for {variant_name}: {e}")
+        print(f"Last output lines:\n{e.stderr}")
+        return False
+    except FileNotFoundError:
+        print(f"Error: '{gold_utils_path}' not found.")
+        return False
 
-                for line in conf_lines:
-                    if line.strip().startswith('cavity_file ='):
-                        new_conf_lines.append(f"cavity_file = {centroid_file_name}\n")
-                        cavity_file_updated = True
-                    elif line.strip().startswith('protein_datafile ='):
-                        new_conf_lines.append(f"protein_datafile = {output_pdb_path}\n")
-                        protein_datafile_updated = True
-                    else:
-                        new_conf_lines.append(line)
+    centroid_file_path = os.path.join(variant_folder, centroid_file_name)
+    if not os.path.exists(centroid_file_path):
+        print(f"Error: '{centroid_file_name}' not found in: {variant_folder}")
+        return False
 
-                if not protein_datafile_updated:
-                    print(f"Warning: 'protein_datafile =' not found in gold.conf for {variant_name}")
-                if not cavity_file_updated:
-                    print(f"Warning: 'cavity_file =' not found in gold.conf for {variant_name}")
+    try:
+        overrides = dict(overrides, cavity_file=centroid_file_name, protein_datafile=output_pdb_path)
+        template.write(destination_conf, overrides)
+
+        previous = (load_build_cache(variant_folder) or {}).get('shard_confs_out', {})
+        shards = write_shard_confs(template, overrides, variant_folder, ligands if hashes['shard_ligands'] else [], previous)
+        save_build_cache(variant_folder, {'inputs': hashes, 'gold_conf_out': file_hash(destination_conf),
+                                          'shard_confs_out': shards})
+        manifest.update(variant_folder, prep_status='done')
+        manifest.record_artifacts(variant_folder, [destination_conf, output_pdb_path]
+                                  + [os.path.join(variant_folder, name) for name in shards])
+        print(f"gold.conf written to: {variant_folder}"
+              + (f" ({len(shards)} per-ligand conf(s) as well)" if shards else ""))
+        print("-" * 20)
+        return True
+
+    except Exception as e:
+        print(f"Error processing folder '{variant_name}': {e}")
+        return False
+
+def prepare_profiled(job):
+    with profiling.span("prepare_variant", variant=job[2]):
+        return prepare_variant(*job)
+
+def ligand_set_overrides(template, ligand_files):
+    """ligand_data_file override for the given ligands; each keeps the template's GA runs
+    when the template lists it, otherwise takes those of the template's first ligand."""
+    template_runs = dict(template.ligands)
+    default_runs = template.ligands[0][1] if template.ligands else 1
+    return [[name, template_runs.get(name, default_runs)] for name in ligand_files]
+
+def run_gold_batch_setup(jobs=None, force=False, monomers_dir=None, template_conf=None, variant_folders=None,
+                         ligand_files=None, shard=False):
+    current_directory = os.getcwd()
+    monomers_dir = monomers_dir or os.path.join(current_directory, 'monomers')
+    template_conf = template_conf or os.path.join(current_directory, source_conf)
+    template_dir = os.path.dirname(os.path.abspath(template_conf))
+
+    # The template is parsed once; every variant's conf is rendered from it in memory.
+    try:
+        template = GoldConf.from_file(template_conf)
+    except FileNotFoundError:
+        print(f"Error: '{template_conf}' not found.")
+        return False
+    all_overrides = load_overrides(os.path.join(template_dir, overrides_file))
+    if ligand_files:
+        # The ligand set given on the command line replaces the template's for every variant;
+        # a variant with its own ligand_data_file in the overrides file keeps it.
+        all_overrides['*'] = dict(all_overrides.get('*', {}),
+                                  ligand_data_file=ligand_set_overrides(template, ligand_files))
+
+    if variant_folders is None:
+        variant_folders = manifest.variant_dirs(monomers_dir)
+
+    pending = []
+    invalid = []
+    up_to_date = 0
+    for variant_folder in variant_folders:
+        # gold.conf names the protein by this path and gold_auto runs inside the variant folder,
+        # so it must not be relative to the current directory.
+        variant_folder = os.path.abspath(variant_folder)
+        variant_name = os.path.basename(variant_folder)
+        if variant_name.startswith('Variant') and variant_name.endswith('_monomer'):
+            variant_id = variant_name.split("Variant")[1].split("_monomer")[0]
+
+            overrides = variant_overrides(all_overrides, variant_name)
+            try:
+                # The variant-specific paths are filled in later; check everything else now.
+                template.merged(dict(overrides, cavity_file=centroid_file_name, protein_datafile=variant_folder))
+            except GoldConfError as e:
+                invalid.append(f"{variant_name}: {e}")
+                continue
+
+            hashes = input_hashes(
+                template_conf,
+                overrides,
+                os.path.join(variant_folder, f"EM_Variant{variant_id}_monomer.pdb"),
+                os.path.join(variant_folder, centroid_file_name),
+                shard,
+            )
+            output_pdb_path = os.path.join(variant_folder, f"EM_Variant{variant_id}_monomer_H.pdb")
+            destination_conf = os.path.join(variant_folder, source_conf)
+            if not force and is_up_to_date(variant_folder, hashes, destination_conf, output_pdb_path):
+                up_to_date += 1
+                manifest.update(variant_folder, prep_status='done')
+                continue
+            pending.append((template, overrides, variant_name, variant_folder, variant_id, hashes))
 
-                with open(destination_conf, 'w') as f:
-                    f.writelines(new_conf_lines)
+    if invalid:
+        print("Error: invalid gold.conf settings, nothing was prepared:")
+        for message in invalid:
+            print(f"  {message}")
+        return False
 
-                print(f"gold.conf updated successfully in: {variant_folder}")
-                print("-" * 20)
+    print(f"{up_to_date} variant(s) already up to date, {len(pending)} to prepare.")
 
-            except Exception as e:
-                print(f"Error processing folder '{variant_name}': {e}")
+    # gold_utils runs are independent, so several are kept in flight at once.
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as pool:
+        results = list(pool.map(prepare_profiled, pending))
+    for job, ok in zip(pending, results):
+        if not ok:
+            manifest.update(job[3], prep_status='failed')
 
-    print("Batch setup completed for all variants.")
+    print(f"Batch setup completed for all variants ({sum(results)} prepared, {len(results) - sum(results)} failed).")
+    return all(results)
 
-run_gold_batch_setup()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Protonate every variant and write its gold.conf.")
+    parser.add_argument("dirs", nargs="*", help="Variant folders to prepare (default: every Variant*_monomer in --monomers-dir).")
+    parser.add_argument("--monomers-dir", help="Folder holding the variants (default: ./monomers).")
+    parser.add_argument("--template", help=f"Template gold.conf; {overrides_file} is read next to it (default: ./{source_conf}).")
+    parser.add_argument("--gold-utils", default=gold_utils_path, help="Path to the gold_utils executable.")
+    parser.add_argument("-j", "--jobs", type=int, help="Number of gold_utils runs in parallel (default: all cores).")
+    parser.add_argument("--force", action="store_true", help="Ignore the build cache and redo every variant.")
+    parser.add_argument("--ligands", nargs="+", metavar="MOL2",
+                        help="Ligand files to dock, relative to each variant folder (default: those listed in the template).")
+    parser.add_argument("--shard-ligands", action="store_true",
+                        help="Also write one gold_<ligand>.conf per ligand, so 5-docking.py docks each ligand as its own job.")
+    args = parser.parse_args()
+    gold_utils_path = args.gold_utils
+    with profiling.stage("4-docking_prep"):
+        ok = run_gold_batch_setup(args.jobs, args.force, args.monomers_dir, args.template, args.dirs or None,
+                                  args.ligands, args.shard_ligands)
+    sys.exit(0 if ok else 1)
@@ -1,77 +1,409 @@
+import argparse
+import datetime
+import json
 import os
+import re
+import shutil
+import socket
 import subprocess
+import sys
+import threading
 import time
-import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import docking_cache
+import manifest
+import profiling
+from gold_conf import GoldConf, ligand_stem, shard_conf_name
+from leases import cooperative_map, lease_lost, stop_on_lease_lost
+from proc_stream import run_logged
+
+# Edit the line below for your files
+base_dir = '/home/your_pc_name/Documents/monomers'
+
+# Edit the line below to include the path where your software is installed.
+docking_command = ['/home/your_pc_name/CCDC/ccdc-software/gold/GOLD/bin/gold_auto', 'gold.conf']
+
+# Wall time of the last successful docking run per job, used to start the longest jobs first.
+runtimes_file_name = 'docking_runtimes.json'
+
+# Per-job state (pending/running/done/failed, see split_job), kept inside each variant folder and
+# rewritten atomically on every transition so an interrupted campaign can resume where
+# it stopped, and so workers on several hosts never write the same file.
+state_file_name = '.docking_state.json'
+# Held by the worker docking a variant in --cooperative mode (see leases.py).
+lease_file_name = '.docking.lease'
+
+# gold_auto output is streamed here, inside each variant folder (rotated, see proc_stream).
+docking_log_name = 'gold_auto.log'
+# GOLD reports which GA run it is on; matching lines update the live progress display.
+progress_re = re.compile(r"\bGA\b.*?\b(\d+)\s*(?:/|of)\s*(\d+)", re.IGNORECASE)
+
+# Results shared between variants with identical pockets (--cache, see docking_cache.py).
+cache_dir_name = '.docking_cache'
+
+status_lock = threading.Lock()
+journal_lock = threading.Lock()
+
+# A docking job is a variant folder name, docked with its gold.conf in one gold_auto run,
+# or "<variant folder>/<ligand>" when 4-docking_prep.py --shard-ligands wrote one conf per
+# ligand. The state, lease and log files of a ligand job carry the ligand name, e.g.
+# .docking_state.L-Asn.json; the protonated protein and cavity are shared by all of them.
+def split_job(job):
+    dir_name, _, ligand = job.partition('/')
+    return dir_name, ligand or None
+
+def job_path(job, file_name):
+    dir_name, ligand = split_job(job)
+    if ligand:
+        root, ext = os.path.splitext(file_name)
+        file_name = f"{root}.{ligand}{ext}"
+    return os.path.join(base_dir, dir_name, file_name)
+
+def job_conf(job):
+    _, ligand = split_job(job)
+    return shard_conf_name(ligand) if ligand else docking_command[-1]
+
+def variant_jobs(dir_name):
+    """One job per ligand if every ligand of gold.conf has its own conf, else the variant."""
+    variant_dir = os.path.join(base_dir, dir_name)
+    try:
+        conf = GoldConf.from_file(os.path.join(variant_dir, docking_command[-1]))
+    except (OSError, ValueError):
+        return [dir_name]
+    stems = [ligand_stem(ligand_file) for ligand_file, _ in conf.ligands]
+    if stems and all(os.path.exists(os.path.join(variant_dir, shard_conf_name(stem))) for stem in stems):
+        return [f"{dir_name}/{stem}" for stem in stems]
+    return [dir_name]
+
+class StateJournal:
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+
+    def path(self, job):
+        return job_path(job, state_file_name)
+
+    def entry(self, job):
+        try:
+            with open(self.path(job), 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def get(self, job):
+        return self.entry(job).get('state')
+
+    def set(self, job, state, **info):
+        record = dict(info, state=state, host=socket.gethostname(),
+                      updated=datetime.datetime.now().isoformat(timespec='seconds'))
+        path = self.path(job)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(record, f, indent=1, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        # The shared manifest mirrors the state for the other stages and for reports.
+        dir_name, ligand = split_job(job)
+        if ligand is None:
+            manifest.update(os.path.dirname(path), docking_status=state, docking_seconds=info.get('seconds'))
+            return
+        with journal_lock:
+            state, seconds = self.variant_state(dir_name)
+            manifest.update(os.path.dirname(path), docking_status=state, docking_seconds=seconds)
+
+    def variant_state(self, dir_name):
+        """(state, seconds) of a variant docked one ligand at a time: failed, running or
+        pending if any ligand is, done once they all are."""
+        entries = [self.entry(job) for job in variant_jobs(dir_name)]
+        states = [entry.get('state') for entry in entries]
+        for state in ('failed', 'running', 'pending'):
+            if state in states:
+                return state, None
+        if all(state == 'done' for state in states):
+            return 'done', round(sum(entry.get('seconds') or 0.0 for entry in entries), 1)
+        return None, None
+
+def expected_outputs(variant_dir, conf_name=None):
+    """The .rnk file GOLD writes for every ligand listed in the conf (default: gold.conf)."""
+    try:
+        conf = GoldConf.from_file(os.path.join(variant_dir, conf_name or docking_command[-1]))
+    except (OSError, ValueError):
+        return []
+    out_dir = os.path.join(variant_dir, conf.settings.get('directory', '.'))
+    outputs = []
+    for ligand_file, _ in conf.ligands:
+        stem = ligand_stem(ligand_file)
+        outputs.append(os.path.join(out_dir, f"{stem}_m1", f"{stem}_m1.rnk"))
+    return outputs
+
+def job_outputs(job):
+    return expected_outputs(os.path.join(base_dir, split_job(job)[0]), job_conf(job))
+
+def outputs_complete(job):
+    outputs = job_outputs(job)
+    return all(os.path.exists(p) and os.path.getsize(p) > 0 for p in outputs)
 
 def update_status_header(file_path, status):
     with open(file_path, 'r+') as file:
         lines = file.readlines()
         file.seek(0)
-        
+
         file.write(lines[0])
         file.write("\n")
-        
+
         if status == 'running':
             file.write("⏳ Please, do not turn off the PC !!! 😊\n\n")
         elif status == 'completed':
             file.write("✅ All tasks have been completed. The PC can be turned off. 😊\n\n")
-            
+
         file.writelines(lines[3:])
         file.truncate()
 
-def run_all_variants():
-    # Edit the line below for your files
-    base_dir = '/home/your_pc_name/Documents/monomers'
-    global_status_file = os.path.join(base_dir, 'docking_status.txt')
-    
-    # Edit the line below to include the path where your software is installed.
-    docking_command = ['/home/your_pc_name/CCDC/ccdc-software/gold/GOLD/bin/gold_auto', 'gold.conf']
+def append_status(file_path, text):
+    # Several docking jobs report at once; keep each report in one piece.
+    with status_lock:
+        with open(file_path, 'a') as file:
+            file.write(text)
+
+def load_runtimes(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def save_runtimes(path, runtimes):
+    # Other workers may have recorded their own jobs since we loaded the file.
+    runtimes = dict(load_runtimes(path), **runtimes)
+    with open(f"{path}.{os.getpid()}.tmp", 'w') as f:
+        json.dump(runtimes, f, indent=1, sort_keys=True)
+    os.replace(f"{path}.{os.getpid()}.tmp", path)
+
+def longest_first(jobs, runtimes):
+    """Order jobs by their last known runtime, longest first.
+
+    Jobs never docked before are assumed to take the average known time.
+    """
+    known = [runtimes[d] for d in jobs if d in runtimes]
+    default = sum(known) / len(known) if known else 0.0
+    return sorted(jobs, key=lambda d: runtimes.get(d, default), reverse=True)
+
+def cache_key(variant_dir, conf_name):
+    """(fingerprint, pocket coordinates) for docking_cache, or None."""
+    try:
+        conf = GoldConf.from_file(os.path.join(variant_dir, conf_name))
+        return docking_cache.fingerprint(variant_dir, conf)
+    except (OSError, KeyError, ValueError) as e:
+        print(f"Docking cache disabled for {variant_dir}: {e}")
+        return None
+
+def dock_variant(job, variant_dir, global_status_file, journal, cache_tolerance=None):
+    """Dock one job: a whole variant, or one of its ligands (see split_job)."""
+    print(f"\nProcessing folder: {variant_dir}" + (f" ({split_job(job)[1]})" if split_job(job)[1] else ""))
+    append_status(global_status_file, f"📂 Starting processing for folder: {job}\n")
+    journal.set(job, 'running')
+
+    cache_dir = os.path.join(base_dir, cache_dir_name)
+    outputs = job_outputs(job)
+    result_dirs = [os.path.dirname(p) for p in outputs]
+    lookup = cache_key(variant_dir, job_conf(job)) if cache_tolerance is not None and result_dirs else None
+    hit = docking_cache.restore(cache_dir, *lookup, cache_tolerance, result_dirs) if lookup else None
+    if hit:
+        cached = f"{lookup[0]}/{hit}"
+        append_status(global_status_file, f"    ♻️  {job}: matching pocket already docked, results reused ({cached[:12]}).\n\n")
+        manifest.record_artifacts(variant_dir, outputs)
+        journal.set(job, 'done', seconds=0.0, cached=cached)
+        return True, 0.0
+
+    # Results restored by an earlier --cache run are hard links into the cache; they are
+    # removed (with or without --cache now) so GOLD never rewrites them in place.
+    for result_dir in result_dirs:
+        shutil.rmtree(result_dir, ignore_errors=True)
+
+    ok, elapsed, error = run_docking(job, variant_dir, global_status_file)
+    if lease_lost():
+        # --cooperative: another worker took the job over and records its outcome.
+        append_status(global_status_file, f"⚠️  {job}: lease taken over by another worker; result not recorded.\n\n")
+        return False, elapsed
+    if ok and not outputs_complete(job):
+        ok, error = False, 'gold_auto finished but .rnk outputs are missing'
+        append_status(global_status_file, f"❌ ERROR ({job}): {error}.\n" + "-" * 20 + "\n\n")
+    if ok:
+        if lookup:
+            docking_cache.store(cache_dir, *lookup, result_dirs)
+        manifest.record_artifacts(variant_dir, outputs)
+        journal.set(job, 'done', seconds=round(elapsed, 1))
+    else:
+        journal.set(job, 'failed', error=error)
+    return ok, elapsed
+
+def progress_reporter(dir_name):
+    last = [None]
+
+    def on_line(line):
+        m = progress_re.search(line)
+        if m and m.groups() != last[0]:
+            last[0] = m.groups()
+            print(f"[progress] {dir_name}: GA run {m.group(1)}/{m.group(2)}")
+    return on_line
+
+def run_docking(job, variant_dir, global_status_file):
+    start = time.monotonic()
+    try:
+        run_logged(
+            docking_command[:-1] + [job_conf(job)],
+            job_path(job, docking_log_name),
+            cwd=variant_dir,
+            on_line=progress_reporter(job),
+            # --cooperative: stop docking into the folder once another worker has taken it over.
+            on_start=stop_on_lease_lost
+        )
+        elapsed = time.monotonic() - start
+        append_status(global_status_file, f"    ✅ {job}: Docking completed successfully ({elapsed:.0f} s).\n\n")
+        return True, elapsed, None
+
+    except FileNotFoundError:
+        error = "gold_auto not found"
+        append_status(
+            global_status_file,
+            f"❌ ERROR ({job}): Command 'gold_auto' not found.\n"
+            "Check if it is in your $PATH or use the absolute path.\n" + "-" * 20 + "\n\n"
+        )
+    except subprocess.CalledProcessError as e:
+        error = f"gold_auto exited with code {e.returncode}"
+        append_status(
+            global_status_file,
+            f"❌ ERROR ({job}): The docking command returned an error.\n"
+            f"Last output lines (full log in {docking_log_name}):\n{e.stderr}\n" + "-" * 20 + "\n\n"
+        )
+    except Exception as e:
+        error = str(e)
+        append_status(global_status_file, f"❌ UNEXPECTED ERROR ({job}): {e}\n" + "-" * 20 + "\n\n")
+    return False, time.monotonic() - start, error
+
+def plan_resume(jobs, journal, restart):
+    """Jobs that still need docking; completed ones with intact outputs are skipped."""
+    todo = []
+    for d in jobs:
+        state = journal.get(d)
+        if restart or state is None:
+            pass
+        elif state == 'done' and outputs_complete(d):
+            print(f"Skipping {d}: already docked.")
+            continue
+        elif state == 'done':
+            print(f"Re-queueing {d}: marked done but its .rnk outputs are missing or empty.")
+        elif state == 'running':
+            print(f"Re-queueing {d}: its previous run was interrupted; partial outputs will be overwritten.")
+        journal.set(d, 'pending')
+        todo.append(d)
+    return todo
+
+def is_handled(job, journal, since):
+    """In cooperative mode: docked, or already failed during this campaign."""
+    entry = journal.entry(job)
+    if entry.get('state') == 'done':
+        return outputs_complete(job)
+    return entry.get('state') == 'failed' and entry.get('updated', '') >= since
+
+def run_pool(queue, work, slots):
+    # The executor starts jobs in submission order and refills a slot as soon as it frees up.
+    with ThreadPoolExecutor(max_workers=slots) as pool:
+        futures = {pool.submit(work, d): d for d in queue}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+def run_all_variants(slots=None, restart=False, cooperative=False, cache_tolerance=None, variants=None):
+    if cooperative:
+        # Every worker keeps its own status file; the shared one would be truncated by each start.
+        status_name = f"docking_status.{socket.gethostname()}.{os.getpid()}.txt"
+    else:
+        status_name = 'docking_status.txt'
+    global_status_file = os.path.join(base_dir, status_name)
+    runtimes_file = os.path.join(base_dir, runtimes_file_name)
+    journal = StateJournal(base_dir)
+    campaign_start = datetime.datetime.now().isoformat(timespec='seconds')
 
     start_time_str = datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S")
-    
-    with open(global_status_file, 'w') as file:
-        file.write(f"📅🕔 {start_time_str} 📅🕔\n\n")
-        file.write("⏳ Please, do not turn off the PC !!! 😊\n\n")
-
-    for dir_name in os.listdir(base_dir):
-        if dir_name.startswith('Variant') and dir_name.endswith('_monomer'):
-            variant_dir = os.path.join(base_dir, dir_name)
-            
-            if os.path.isdir(variant_dir):
-                print(f"\nProcessing folder: {variant_dir}")
-                
-                with open(global_status_file, 'a') as file:
-                    file.write(f"📂 Starting processing for folder: {dir_name}\n")
-                
-                try:
-                    result = subprocess.run(
-                        docking_command,
-                        cwd=variant_dir,
-                        capture_output=True,
-                        text=True,
-                        check=True
-                    )
-                    
-                    with open(global_status_file, 'a') as file:
-                        file.write("    ✅ Docking completed successfully.\n\n")
-
-                except FileNotFoundError:
-                    with open(global_status_file, 'a') as file:
-                        file.write("❌ ERROR: Command 'gold_auto' not found.\n")
-                        file.write("Check if it is in your $PATH or use the absolute path.\n")
-                        file.write("-" * 20 + "\n\n")
-                except subprocess.CalledProcessError as e:
-                    with open(global_status_file, 'a') as file:
-                        file.write("❌ ERROR: The docking command returned an error.\n")
-                        file.write(f"Error output:\n{e.stderr}\n")
-                        file.write("-" * 20 + "\n\n")
-                except Exception as e:
-                    with open(global_status_file, 'a') as file:
-                        file.write(f"❌ UNEXPECTED ERROR: {e}\n")
-                        file.write("-" * 20 + "\n\n")
-    
-    update_status_header(global_status_file, 'completed')
-        
-    print("\nDocking process completed for all variants. Check the file 'docking_status.txt'.")
-    
-run_all_variants()
+
+    # Runs limited to a few variants (e.g. from pipeline.py) add to the existing status file.
+    if not variants or not os.path.exists(global_status_file):
+        with open(global_status_file, 'w') as file:
+            file.write(f"📅🕔 {start_time_str} 📅🕔\n\n")
+            file.write("⏳ Please, do not turn off the PC !!! 😊\n\n")
+
+    if variants:
+        dir_names = [os.path.basename(os.path.normpath(d)) for d in variants]
+    else:
+        dir_names = [os.path.basename(d) for d in manifest.variant_dirs(base_dir)]
+    # Ligand jobs of all variants share one queue, so the slots stay busy across variants.
+    jobs = [job for d in dir_names for job in variant_jobs(d)]
+    runtimes = load_runtimes(runtimes_file)
+    slots = slots or os.cpu_count() or 1
+
+    submitted = time.monotonic()
+
+    def work(job):
+        dir_name, ligand = split_job(job)
+        fields = {'ligand': ligand} if ligand else {}
+        with profiling.span("dock_variant", variant=dir_name, queued_s=round(time.monotonic() - submitted, 3), **fields):
+            return dock_variant(job, os.path.join(base_dir, dir_name), global_status_file, journal, cache_tolerance)
+
+    if cooperative:
+        # Leases decide who docks what; the journal of a job is only touched by its lease holder.
+        queue = longest_first(jobs, runtimes)
+        print(f"Cooperative docking of {len(queue)} jobs ({len(dir_names)} variants) with {slots} local slot(s).")
+        results = cooperative_map(
+            queue,
+            lambda job: job_path(job, lease_file_name),
+            lambda job: is_handled(job, journal, campaign_start),
+            work,
+            slots,
+        )
+    else:
+        queue = longest_first(plan_resume(jobs, journal, restart), runtimes)
+        print(f"Docking {len(queue)} jobs ({len(dir_names)} variants) with {slots} concurrent job(s).")
+        results = run_pool(queue, work, slots)
+
+    failed = 0
+    for done, (job, (ok, elapsed)) in enumerate(results, 1):
+        print(f"[{done}] {job}: {'done' if ok else 'FAILED'} in {elapsed:.0f} s")
+        failed += not ok
+        if ok and elapsed > 0:
+            runtimes[job] = elapsed
+            save_runtimes(runtimes_file, runtimes)
+
+    if not variants:
+        update_status_header(global_status_file, 'completed')
+
+    print(f"\nDocking process completed for all variants. Check the file '{status_name}'.")
+    return failed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run GOLD docking for every variant.")
+    parser.add_argument("variants", nargs="*", help="Variant folder names to dock (default: every Variant*_monomer in --base-dir).")
+    parser.add_argument("--base-dir", default=base_dir, help="Folder holding the Variant*_monomer directories.")
+    parser.add_argument("-n", "--slots", type=int,
+                        help="Docking jobs kept in flight; match it to your cores and GOLD licence seats (default: all cores).")
+    parser.add_argument("--restart", action="store_true",
+                        help="Ignore the state journal and dock every variant again (not with --cooperative).")
+    parser.add_argument("--cooperative", action="store_true",
+                        help="Share the campaign with other workers (any host) through lease files. "
+                             "The SQLite manifest is not updated, as its locking is unreliable over NFS.")
+    parser.add_argument("--cache", action="store_true",
+                        help="Reuse results of an earlier variant whose pocket, ligands and settings are identical.")
+    parser.add_argument("--cache-tolerance", type=float, default=0.0,
+                        help="With --cache, reuse a pocket whose atoms all lie within this many Å of the variant's (default: exact to 0.001).")
+    parser.add_argument("--gold-auto", default=docking_command[0], help="Path to the gold_auto executable.")
+    args = parser.parse_args()
+    base_dir = args.base_dir
+    # gold_auto runs inside the variant folder; a relative path would no longer resolve there.
+    gold_auto = os.path.abspath(args.gold_auto) if os.sep in args.gold_auto else args.gold_auto
+    docking_command = [gold_auto] + docking_command[1:]
+    if args.cooperative:
+        manifest.writes_enabled = False
+    with profiling.stage("5-docking"):
+        failed = run_all_variants(args.slots, args.restart, args.cooperative,
+                                  args.cache_tolerance if args.cache else None, args.variants)
+    sys.exit(1 if failed else 0)
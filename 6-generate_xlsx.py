@@ -1,21 +1,40 @@
+import argparse
 import os
-import glob
+import math
+
+import numpy as np
 import pandas as pd
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Alignment, Font
+from openpyxl.utils import get_column_letter
+
+import manifest
+import profiling
+
+column_names = [
+    'Mol No', 'Score', 'S(PLP)', 'S(hbond)', 'S(cho)', 'S(metal)',
+    'DE(clash)', 'DE(tors)', 'intcor', 'time'
+]
+
+# GOLD writes one <ligand>_m1/<ligand>_m1.rnk result folder per docked ligand.
+result_suffix = '_m1'
+# Names used in the workbook and summary for the ligands of the original campaign; any
+# other ligand is shown by its file stem. Their order is also the column order.
+ligand_names = {'L-Asn': 'Asparagine', 'L-Gln': 'Glutamine'}
+ligand_short_names = {'L-Asn': 'Asn', 'L-Gln': 'Gln'}
+default_selectivity = ('L-Asn', 'L-Gln')
 
 def parse_rnk_file_to_dataframe(filepath):
-    column_names = [
-        'Mol No', 'Score', 'S(PLP)', 'S(hbond)', 'S(cho)', 'S(metal)',
-        'DE(clash)', 'DE(tors)', 'intcor', 'time'
-    ]
+    """Read a GOLD .rnk ranking into a DataFrame indexed by 'Mol No'.
+
+    The table is split and converted in one NumPy pass instead of going through the
+    generic CSV reader. Rows whose first field is not a pose number are ignored and
+    only the first row of each pose is kept.
+    """
     try:
-        df = pd.read_csv(filepath, skiprows=4, sep=r'\s+', names=column_names)
-        df['Mol No'] = pd.to_numeric(df['Mol No'], errors='coerce')
-        df.dropna(subset=['Mol No'], inplace=True)
-        df['Mol No'] = df['Mol No'].astype(int)
-        df.drop_duplicates(subset='Mol No', keep='first', inplace=True)
-        df.set_index('Mol No', inplace=True)
-        return df
+        with open(filepath, 'rb') as f:
+            lines = f.read().splitlines()[4:]
     except FileNotFoundError:
         print(f"WARNING: File {filepath} was not found and will be skipped.")
         return None
@@ -23,15 +42,244 @@ def parse_rnk_file_to_dataframe(filepath):
         print(f"An error occurred while reading {filepath}: {e}")
         return None
 
+    n_cols = len(column_names)
+    rows = []
+    for line in lines:
+        fields = line.split()
+        if fields and fields[0].isdigit():
+            rows.append((fields + [b'nan'] * n_cols)[:n_cols])
+    try:
+        table = np.array(rows, dtype=float).reshape(-1, n_cols)
+    except ValueError as e:
+        print(f"An error occurred while reading {filepath}: {e}")
+        return None
+
+    mol_no = table[:, 0].astype(int)
+    _, first = np.unique(mol_no, return_index=True)
+    first.sort()
+    df = pd.DataFrame(table[first, 1:], columns=column_names[1:], index=pd.Index(mol_no[first], name='Mol No'))
+    return df
+
+def parse_rnk_profiled(path):
+    with profiling.span("parse_rnk", variant=os.path.basename(os.path.dirname(os.path.dirname(path)))):
+        return parse_rnk_file_to_dataframe(path)
+
+def discover_rankings(variant_path):
+    """{ligand: .rnk path} for every ligand result folder found in a variant folder."""
+    rankings = {}
+    for entry in os.scandir(variant_path):
+        if entry.is_dir() and entry.name.endswith(result_suffix):
+            path = os.path.join(entry.path, f"{entry.name}.rnk")
+            if os.path.exists(path):
+                rankings[entry.name[:-len(result_suffix)]] = path
+    return rankings
+
+def order_ligands(found):
+    known = [ligand for ligand in ligand_names if ligand in found]
+    return known + sorted(ligand for ligand in found if ligand not in ligand_names)
+
+def short_name(ligand):
+    return ligand_short_names.get(ligand, ligand)
+
+def find_ligand(name, ligands):
+    """The ligand called name (file stem or short name, any case), or None."""
+    for ligand in ligands:
+        if name.lower() in (ligand.lower(), short_name(ligand).lower()):
+            return ligand
+    return None
+
+def load_rnk_files(paths):
+    """Parse many .rnk files; returns {path: DataFrame or None}.
+
+    The files are small and parsing holds the GIL, so a thread pool was measured slower
+    than this plain loop.
+    """
+    return {path: parse_rnk_profiled(path) for path in paths}
+
+def score_columns(df, poses):
+    if df is None:
+        return np.full(len(poses), np.nan)
+    return df['Score'].reindex(poses).to_numpy()
+
+def cell_value(score):
+    # Missing poses stay empty cells, as with DataFrame.to_excel.
+    return None if math.isnan(score) else float(score)
+
+def top_k_mean(scores, k):
+    """Row-wise mean of the k best scores of a (variants x poses) array, ignoring NaN."""
+    ranked = -np.sort(-np.where(np.isnan(scores), -np.inf, scores), axis=1)[:, :k]
+    finite = np.isfinite(ranked)
+    counts = finite.sum(axis=1)
+    totals = np.where(finite, ranked, 0.0).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, totals / counts, np.nan)
+
+def summarize(blocks, poses, ligands, top_k=5, rank_by='selectivity', top_n=None,
+              selectivity=default_selectivity):
+    """Best pose and top-k mean of every ligand, and the selectivity, of every variant, ranked.
+
+    All variants are stacked into one (variants x poses) array per ligand and the
+    statistics are computed for all of them at once. GOLD scores are fitness values
+    (higher is better), so selectivity = best target score - best off-target score, for
+    the (target, off-target) pair of ligands given; it is left out if either is missing.
+    rank_by is 'selectivity' or one of the ligands.
+    """
+    names = [folder_name for folder_name, _ in blocks]
+    if not len(poses):
+        # No pose was parsed at all: keep one empty column so the reductions stay defined.
+        poses = np.array([0])
+        blocks = [(name, [np.full(1, np.nan) for _ in ligands]) for name in names]
+
+    def best(scores):
+        has_score = ~np.isnan(scores).all(axis=1)
+        filled = np.where(np.isnan(scores), -np.inf, scores)
+        best_index = filled.argmax(axis=1)
+        best_score = np.where(has_score, filled[np.arange(len(filled)), best_index], np.nan)
+        best_pose = pd.Series(poses[best_index], dtype='Int64').where(has_score)
+        return best_score, best_pose
+
+    columns = {'Variant': names}
+    stats = {}
+    for i, ligand in enumerate(ligands):
+        scores = np.vstack([ligand_scores[i] for _, ligand_scores in blocks])
+        best_score, best_pose = best(scores)
+        stats[ligand] = (best_score, top_k_mean(scores, top_k))
+        short = short_name(ligand)
+        columns[f'Best {short}'] = best_score
+        columns[f'Best {short} Pose'] = best_pose
+        columns[f'Top-{top_k} Mean {short}'] = stats[ligand][1]
+    target, off_target = selectivity
+    if target in stats and off_target in stats:
+        columns['Selectivity'] = stats[target][0] - stats[off_target][0]
+        columns[f'Top-{top_k} Selectivity'] = stats[target][1] - stats[off_target][1]
+    summary = pd.DataFrame(columns)
+
+    if rank_by == 'selectivity':
+        sort_column = 'Selectivity' if 'Selectivity' in summary else f'Best {short_name(ligands[0])}'
+    else:
+        sort_column = f'Best {short_name(rank_by)}'
+    summary = summary.sort_values(sort_column, ascending=False, na_position='last', kind='stable')
+    summary.insert(0, 'Rank', np.arange(1, len(summary) + 1))
+    if top_n is not None:
+        summary = summary.head(top_n)
+    return summary.reset_index(drop=True)
+
+def write_summary_sheet(workbook, summary):
+    worksheet = workbook.create_sheet('Summary')
+    header_font = Font(bold=True)
+    center_align = Alignment(horizontal='center', vertical='center')
+    header = []
+    for name in summary.columns:
+        cell = WriteOnlyCell(worksheet, value=name)
+        cell.font = header_font
+        cell.alignment = center_align
+        header.append(cell)
+    worksheet.append(header)
+    for row in summary.astype(object).itertuples(index=False):
+        worksheet.append([None if pd.isna(v) else v for v in row])
+
+def write_results_workbook(output_filename, blocks, poses, ligands, summary=None):
+    """Stream the Pose / one column per ligand grid through a write-only workbook.
+
+    blocks is a list of (folder_name, [scores of each ligand]). Each row is written once
+    and never revisited, so no worksheet is held in memory however many variants there are.
+    """
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet('Results')
+
+    header_font = Font(bold=True)
+    center_align = Alignment(horizontal='center', vertical='center')
+
+    def header(value):
+        cell = WriteOnlyCell(worksheet, value=value)
+        cell.font = header_font
+        cell.alignment = center_align
+        return cell
+
+    row_names = [header("Pose")]
+    row_ligands = [None]
+    worksheet.merged_cells.add('A1:A2')
+    width = len(ligands) + 1
+    for i, (folder_name, _) in enumerate(blocks):
+        start_col = 2 + (i * width)
+        row_names += [header(folder_name)] + [None] * len(ligands)
+        row_ligands += [ligand_names.get(ligand, ligand) for ligand in ligands] + [None]
+        if len(ligands) > 1:
+            worksheet.merged_cells.add(
+                f"{get_column_letter(start_col)}1:{get_column_letter(start_col + len(ligands) - 1)}1")
+    worksheet.append(row_names)
+    worksheet.append(row_ligands)
+
+    for row, pose in enumerate(poses):
+        values = [int(pose)]
+        for _, ligand_scores in blocks:
+            values += [cell_value(scores[row]) for scores in ligand_scores] + [None]
+        worksheet.append(values)
+
+    if summary is not None:
+        write_summary_sheet(workbook, summary)
+
+    workbook.save(output_filename)
+
+def long_format(folder_name, ligand, df):
+    """Every .rnk column of one ranking, one row per pose."""
+    out = df.reset_index().rename(columns={'Mol No': 'Pose'})
+    out.insert(0, 'Ligand', ligand)
+    out.insert(0, 'Variant', folder_name)
+    return out
+
+def write_long_output(path, frames):
+    """Write per-variant frames to CSV or Parquet (by extension), one block at a time."""
+    if path.endswith('.parquet'):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            print("WARNING: pyarrow is not installed; writing CSV instead of Parquet.")
+            path = path[:-len('.parquet')] + '.csv'
+        else:
+            writer = None
+            for frame in frames:
+                table = pa.Table.from_pandas(frame, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+            if writer is not None:
+                writer.close()
+            return path
+
+    with open(path, 'w', newline='') as f:
+        first = True
+        for frame in frames:
+            frame.to_csv(f, header=first, index=False)
+            first = False
+    return path
+
 def main():
-    monomers_path = "../monomers"
+    parser = argparse.ArgumentParser(description="Collect GOLD scores of every variant into results.xlsx.")
+    parser.add_argument("--monomers-dir", default="../monomers")
+    parser.add_argument("-o", "--output", default="results.xlsx")
+    parser.add_argument("--long-output",
+                        help="Also write every .rnk column in long format (Variant, Ligand, Pose, ...) to this .parquet or .csv file.")
+    parser.add_argument("--top-k", type=int, default=5,
+                        help="Number of best poses averaged in the summary (default: 5).")
+    parser.add_argument("--rank-by", default='selectivity',
+                        help="Summary ranking: selectivity (default) or the best score of a ligand, e.g. asn, gln or L-Asn.")
+    parser.add_argument("--selectivity", nargs=2, default=list(default_selectivity), metavar=("TARGET", "OFF_TARGET"),
+                        help="Ligands compared by the Selectivity columns (default: L-Asn L-Gln).")
+    parser.add_argument("--top-n", type=int,
+                        help="Only keep the N best-ranked variants in the summary.")
+    parser.add_argument("--summary-output",
+                        help="Also write the ranked summary to this .csv file.")
+    args = parser.parse_args()
+
+    monomers_path = args.monomers_dir
 
     if not os.path.isdir(monomers_path):
         print(f"ERROR: The monomers folder was not found in: '{monomers_path}'")
         return
 
-    search_pattern = os.path.join(monomers_path, "Variant*_*_monomer")
-    variant_folders = sorted(glob.glob(search_pattern))
+    variant_folders = manifest.variant_dirs(monomers_path)
 
     if not variant_folders:
         print(f"ERROR: No 'Variant...' folders were found inside '{monomers_path}'")
@@ -39,61 +287,58 @@ def main():
 
     print(f"Found {len(variant_folders)} variant folders to process...")
 
-    df_agg = pd.DataFrame({'Score': list(range(1, 200))})
-    df_agg.set_index('Score', inplace=True)
-
-    for variant_path in variant_folders:
-        folder_name = os.path.basename(variant_path)
-        print(f"Processing: {folder_name}")
+    # Every ligand docked for any variant gets a column; the others leave it empty.
+    rnk_paths = {variant_path: discover_rankings(variant_path) for variant_path in variant_folders}
+    ligands = order_ligands({ligand for found in rnk_paths.values() for ligand in found}) or list(ligand_names)
+    print(f"Ligands: {', '.join(ligands)}")
+    parsed = load_rnk_files([p for found in rnk_paths.values() for p in found.values()])
 
-        path_asn = os.path.join(variant_path, 'L-Asn_m1', 'L-Asn_m1.rnk')
-        path_gln = os.path.join(variant_path, 'L-Gln_m1', 'L-Gln_m1.rnk')
+    rank_by = args.rank_by if args.rank_by == 'selectivity' else find_ligand(args.rank_by, ligands)
+    if rank_by is None:
+        print(f"ERROR: --rank-by {args.rank_by}: no such ligand ({', '.join(ligands)}).")
+        return
+    selectivity = tuple(find_ligand(name, ligands) for name in args.selectivity)
+    if args.selectivity != list(default_selectivity) and None in selectivity:
+        print(f"ERROR: --selectivity {' '.join(args.selectivity)}: no such ligand ({', '.join(ligands)}).")
+        return
 
-        df_asn = parse_rnk_file_to_dataframe(path_asn)
-        df_gln = parse_rnk_file_to_dataframe(path_gln)
+    # Size the table from the data: as many rows as the largest pose number found.
+    n_poses = max([int(df.index.max()) for df in parsed.values() if df is not None and len(df)] or [0])
+    poses = np.arange(1, n_poses + 1)
 
-        score = list(range(1, 201))
-        scores_asn = df_asn.reindex(score)['Score'] if df_asn is not None else pd.Series(index=score, dtype=float)
-        scores_gln = df_gln.reindex(score)['Score'] if df_gln is not None else pd.Series(index=score, dtype=float)
+    blocks = []
+    for variant_path in variant_folders:
+        found = rnk_paths[variant_path]
+        blocks.append((
+            os.path.basename(variant_path),
+            [score_columns(parsed[found[ligand]] if ligand in found else None, poses) for ligand in ligands],
+        ))
 
-        df_agg[f'{folder_name}_Asn'] = scores_asn.values
-        df_agg[f'{folder_name}_Gln'] = scores_gln.values
-        df_agg[f'spacer_{folder_name}'] = ''
+    summary = summarize(blocks, poses, ligands, top_k=args.top_k, rank_by=rank_by, top_n=args.top_n,
+                        selectivity=selectivity)
 
-    output_filename = 'results.xlsx'
+    output_filename = args.output
     print(f"\nCreating Excel file: {output_filename}")
+    with profiling.span("write_workbook", variants=len(blocks)):
+        write_results_workbook(output_filename, blocks, poses, ligands, summary)
 
-    with pd.ExcelWriter(output_filename, engine='openpyxl') as writer:
-        df_agg.reset_index().to_excel(writer, sheet_name='Results', startrow=2, header=False, index=False)
-
-        workbook = writer.book
-        worksheet = writer.sheets['Results']
-
-        header_font = Font(bold=True)
-        center_align = Alignment(horizontal='center', vertical='center')
-
-        cell_pose = worksheet['A1']
-        cell_pose.value = "Pose"
-        cell_pose.font = header_font
-        cell_pose.alignment = center_align
-        worksheet.merge_cells('A1:A2')
-
-        for i, variant_path in enumerate(variant_folders):
-            folder_name = os.path.basename(variant_path)
-            start_col = 2 + (i * 3)
-            end_col = start_col + 1
-
-            cell_header = worksheet.cell(row=1, column=start_col)
-            cell_header.value = folder_name
-            cell_header.font = header_font
-            cell_header.alignment = center_align
-            worksheet.merge_cells(start_row=1, start_column=start_col, end_row=1, end_column=end_col)
+    if args.summary_output:
+        summary.to_csv(args.summary_output, index=False)
+        print(f"Ranked summary written to: {os.path.abspath(args.summary_output)}")
 
-            worksheet.cell(row=2, column=start_col).value = "Asparagine"
-            worksheet.cell(row=2, column=end_col).value = "Glutamine"
+    if args.long_output:
+        frames = (
+            long_format(os.path.basename(variant_path), os.path.basename(os.path.dirname(path)), parsed[path])
+            for variant_path in variant_folders
+            for path in (rnk_paths[variant_path].get(ligand) for ligand in ligands)
+            if path is not None and parsed[path] is not None
+        )
+        long_path = write_long_output(args.long_output, frames)
+        print(f"Long-format results written to: {os.path.abspath(long_path)}")
 
     print("\nProcess completed successfully!")
     print(f"File '{output_filename}' created at: {os.path.abspath(output_filename)}")
 
 if __name__ == "__main__":
-    main()
+    with profiling.stage("6-generate_xlsx"):
+        main()
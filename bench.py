@@ -0,0 +1,316 @@
+"""Benchmark stages 1-6 on a synthetic campaign, without GROMACS, PyMOL or GOLD.
+
+A campaign of N Variant*_monomer folders is generated in a temporary directory: EM logs
+(a configurable share of them not converged), protein PDBs built around a reference with
+an ASN 401 ligand, and the inputs stage 4 and 5 expect. gmx, gold_utils and gold_auto are
+replaced by small stand-ins with a configurable latency; gold_auto writes a .rnk ranking
+with random scores for every ligand in gold.conf.
+
+Every stage is run as a script, the way it is run by hand, and timed:
+
+    python bench.py --variants 200 --gold-latency 0.2 --save baseline.json
+    python bench.py --variants 200 --gold-latency 0.2 --baseline baseline.json
+
+The report gives the wall time and throughput of each stage, and the p50/p95 latency of
+the stand-in calls it made, so the overhead of the scripts themselves is visible. It is
+printed and written to bench_output.txt. --pipeline times pipeline.py end to end instead.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+scripts_dir = os.path.dirname(os.path.abspath(__file__))
+output_file = "bench_output.txt"
+
+amino_acids = ["ALA", "GLY", "SER", "THR", "LEU", "ASP", "LYS", "GLU", "VAL", "ILE"]
+
+# The stand-ins log one JSON line per call to $BENCH_CALLS: tool, folder, start and end time.
+stub_header = f"""#!{sys.executable}
+import json, os, sys, time
+start = time.time()
+def done():
+    with open(os.environ["BENCH_CALLS"], "a") as f:
+        f.write(json.dumps({{"tool": TOOL, "cwd": os.getcwd(), "start": start, "end": time.time()}}) + "\\n")
+def arg(flag):
+    return sys.argv[sys.argv.index(flag) + 1] if flag in sys.argv else None
+"""
+
+gmx_stub = """TOOL = "gmx " + sys.argv[1]
+if sys.argv[1] == "mdrun":
+    time.sleep(float(os.environ.get("BENCH_GMX_LATENCY", "0")))
+    deffnm = arg("-deffnm")
+    for step in range(0, 501, 100):
+        print(f"Step=  {step}, Dmax= 1.0e-02 nm, Epot= -1.0e+06 Fmax= {1000 - step * 1.9:.5e}, atom= 5")
+    print("Steepest Descents converged to Fmax < 100 in 501 steps")
+    with open(deffnm + ".log", "w") as f:
+        f.write("Steepest Descents converged to Fmax < 100 in 501 steps\\n")
+        f.write("Maximum force     =  9.80000e+01 on atom 5\\n")
+    for ext in (".gro", ".edr", ".trr"):
+        open(deffnm + ext, "w").close()
+else:
+    open(arg("-o"), "w").close()
+done()
+"""
+
+gold_utils_stub = """TOOL = "gold_utils"
+time.sleep(float(os.environ.get("BENCH_GOLD_UTILS_LATENCY", "0")))
+with open(arg("-i")) as src, open(arg("-o"), "w") as dst:
+    dst.write(src.read())
+print("Protonation done")
+done()
+"""
+
+gold_auto_stub = """TOOL = "gold_auto"
+import random
+latency = float(os.environ.get("BENCH_GOLD_LATENCY", "0"))
+poses = int(os.environ.get("BENCH_POSES", "10"))
+ligands = [line.split()[1] for line in open(sys.argv[1]) if line.strip().startswith("ligand_data_file")]
+for i in range(1, 4):
+    print(f"Starting GA run {i} of 3", flush=True)
+    time.sleep(latency / 3)
+rng = random.Random(os.getcwd())
+for ligand in ligands:
+    stem = os.path.splitext(os.path.basename(ligand))[0]
+    os.makedirs(f"{stem}_m1", exist_ok=True)
+    with open(f"{stem}_m1/{stem}_m1.rnk", "w") as f:
+        f.write("# GOLD ranking\\n#\\n# Mol No  Score  S(PLP)  S(hbond)  S(cho)  S(metal)  DE(clash)  DE(tors)  intcor  time\\n#\\n")
+        for pose in range(1, poses + 1):
+            f.write(f"{pose:6d} {rng.uniform(30, 70):8.2f} {rng.uniform(20, 50):8.2f} 1.00 0.00 0.00 -0.50 -1.20 0.30 1.10\\n")
+done()
+"""
+
+gold_conf_template = """  GOLD CONFIGURATION FILE
+
+  POPULATION
+popsiz = auto
+
+  DATA FILES
+ligand_data_file L-Asn.mol2 10
+ligand_data_file L-Gln.mol2 10
+param_file = DEFAULT
+
+  PROTEIN DATA
+protein_datafile = placeholder.pdb
+
+  FLOOD FILL
+radius = 10
+cavity_file = placeholder.txt
+"""
+
+
+def write_stub(bin_dir, name, body):
+    path = os.path.join(bin_dir, name)
+    with open(path, "w") as f:
+        f.write(stub_header + body)
+    os.chmod(path, 0o755)
+    return path
+
+
+def write_pdb(path, residues, sequence, ligand=None, rotation=np.eye(3), shift=np.zeros(3)):
+    with open(path, "w") as f:
+        n = 1
+        for i, (resn, atoms) in enumerate(zip(sequence, residues)):
+            for name, xyz in atoms:
+                x, y, z = xyz @ rotation.T + shift
+                f.write(f"ATOM  {n:5d} {name:<4s} {resn:3s} A{i + 1:4d}    {x:8.3f}{y:8.3f}{z:8.3f}  1.00  0.00\n")
+                n += 1
+        for name, xyz in ligand or []:
+            x, y, z = xyz @ rotation.T + shift
+            f.write(f"HETATM{n:5d} {name:<4s} ASN A 401    {x:8.3f}{y:8.3f}{z:8.3f}  1.00  0.00\n")
+            n += 1
+        f.write("END\n")
+
+
+def make_campaign(root, n_variants, unconverged, residues=150, seed=0):
+    """Reference PDB, gold.conf template and n_variants variant folders under root/monomers."""
+    rng = np.random.default_rng(seed)
+    ca = np.cumsum(rng.normal(0, 2.2, (residues, 3)), axis=0)
+    backbone = [[(name, c + rng.normal(0, 0.5, 3)) for name in ("N", "C", "O")] + [("CA", c)] for c in ca]
+    sequence = [amino_acids[j] for j in rng.integers(0, len(amino_acids), residues)]
+    ligand = [(name, ca[residues // 2] + rng.normal(0, 1.5, 3)) for name in ("N", "CA", "C", "O", "CB")]
+    write_pdb(os.path.join(root, "6v2a_monomer.pdb"), backbone, sequence, ligand)
+    with open(os.path.join(root, "gold.conf"), "w") as f:
+        f.write(gold_conf_template)
+
+    monomers = os.path.join(root, "monomers")
+    for i in range(n_variants):
+        name = f"Variant{i}_A{i}_monomer"
+        folder = os.path.join(monomers, name)
+        os.makedirs(folder)
+        for file_name in ("EM.mdp", "box_solv_ion.gro", "topol.top", "L-Asn.mol2", "L-Gln.mol2"):
+            open(os.path.join(folder, file_name), "w").close()
+        converged = rng.random() >= unconverged
+        with open(os.path.join(folder, "EM.log"), "w") as f:
+            if converged:
+                f.write("Steepest Descents converged to Fmax < 100 in 812 steps\n")
+                f.write(f"Maximum force     =  {rng.uniform(50, 99):.5e} on atom 5\n")
+            else:
+                f.write("Steepest Descents did not reach the requested Fmax < 100 in 5000 steps\n")
+                f.write(f"Maximum force     =  {rng.uniform(150, 900):.5e} on atom 5\n")
+
+        mutated = list(sequence)
+        mutated[rng.integers(0, residues)] = "TRP"
+        theta = rng.uniform(0, 2 * np.pi)
+        rotation = np.array([[np.cos(theta), -np.sin(theta), 0], [np.sin(theta), np.cos(theta), 0], [0, 0, 1]])
+        moved = [[(atom, xyz + rng.normal(0, 0.2, 3)) for atom, xyz in res] for res in backbone]
+        write_pdb(os.path.join(folder, f"EM_Variant{i}_A{i}_monomer.pdb"), moved, mutated,
+                  rotation=rotation, shift=rng.normal(0, 5, 3))
+    return monomers
+
+
+def stage_commands(root, monomers, bin_dir, jobs):
+    python = [sys.executable]
+    script = lambda name: python + [os.path.join(scripts_dir, name)]
+    return [
+        ("1-minimization", script("1-minimization.py") + ["--monomers-dir", monomers, "-j", str(jobs), "-t", "1"]),
+        ("2-filter_minimization", script("2-filter_minimization.py") + ["--base-dir", monomers]),
+        ("3-find_centroid", script("3-find_centroid.py") + [
+            "--monomers-dir", monomers, "--reference", os.path.join(root, "6v2a_monomer.pdb"), "--images", "none"]),
+        ("4-docking_prep", script("4-docking_prep.py") + [
+            "--monomers-dir", monomers, "--template", os.path.join(root, "gold.conf"), "-j", str(jobs),
+            "--gold-utils", os.path.join(bin_dir, "gold_utils")]),
+        ("5-docking", script("5-docking.py") + [
+            "--base-dir", monomers, "-n", str(jobs), "--gold-auto", os.path.join(bin_dir, "gold_auto")]),
+        ("6-generate_xlsx", script("6-generate_xlsx.py") + [
+            "--monomers-dir", monomers, "--output", os.path.join(root, "results.xlsx")]),
+    ]
+
+
+def pipeline_command(root, monomers, bin_dir, jobs):
+    return [sys.executable, os.path.join(scripts_dir, "pipeline.py"),
+            "--monomers-dir", monomers, "--reference", os.path.join(root, "6v2a_monomer.pdb"),
+            "--template", os.path.join(root, "gold.conf"), "--output", os.path.join(root, "results.xlsx"),
+            "--gold-utils", os.path.join(bin_dir, "gold_utils"), "--gold-auto", os.path.join(bin_dir, "gold_auto"),
+            "--em-jobs", str(jobs), "--em-threads", "1", "--dock-slots", str(jobs), "-j", str(jobs)]
+
+
+def read_calls(path):
+    try:
+        with open(path) as f:
+            return [json.loads(line) for line in f]
+    except FileNotFoundError:
+        return []
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+
+def run_stage(name, command, root, env, calls_path, n_variants):
+    open(calls_path, "w").close()
+    log_path = os.path.join(root, f"bench_{name}.log")
+    start = time.perf_counter()
+    with open(log_path, "w") as log:
+        returncode = subprocess.run(command, cwd=root, env=env, stdout=log, stderr=subprocess.STDOUT).returncode
+    wall = time.perf_counter() - start
+    latencies = [c["end"] - c["start"] for c in read_calls(calls_path)]
+    return {
+        "stage": name,
+        "ok": returncode == 0,
+        "wall_s": round(wall, 3),
+        "variants_per_s": round(n_variants / wall, 2) if wall > 0 else None,
+        "tool_calls": len(latencies),
+        "tool_p50_s": percentile(latencies, 50),
+        "tool_p95_s": percentile(latencies, 95),
+        "log": log_path,
+    }
+
+
+def format_report(results, args, baseline=None):
+    base = {r["stage"]: r for r in (baseline or {}).get("stages", [])}
+    lines = [
+        f"Benchmark: {args.variants} variants, {args.jobs} job(s), {args.poses} poses, "
+        f"latency gmx {args.gmx_latency} s / gold_utils {args.gold_utils_latency} s / gold_auto {args.gold_latency} s",
+        "",
+        f"{'Stage':<24} {'OK':<3} {'Wall (s)':>9} {'Var/s':>8} {'Calls':>6} {'p50 (s)':>8} {'p95 (s)':>8}"
+        + (f" {'vs base':>8}" if baseline else ""),
+    ]
+    for r in results:
+        p50 = f"{r['tool_p50_s']:.3f}" if r["tool_p50_s"] is not None else "-"
+        p95 = f"{r['tool_p95_s']:.3f}" if r["tool_p95_s"] is not None else "-"
+        line = (f"{r['stage']:<24} {'yes' if r['ok'] else 'NO':<3} {r['wall_s']:>9.2f} "
+                f"{r['variants_per_s'] or 0:>8.2f} {r['tool_calls']:>6} {p50:>8} {p95:>8}")
+        if baseline:
+            ref = base.get(r["stage"])
+            line += f" {r['wall_s'] / ref['wall_s']:>7.2f}x" if ref and ref["wall_s"] else f" {'-':>8}"
+        lines.append(line)
+    lines.append(f"{'total':<24} {'':<3} {sum(r['wall_s'] for r in results):>9.2f}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time stages 1-6 on a synthetic campaign with stand-in tools.")
+    parser.add_argument("--variants", type=int, default=50)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="-j / -n passed to the stages.")
+    parser.add_argument("--unconverged", type=float, default=0.2, help="Share of EM logs that did not converge.")
+    parser.add_argument("--poses", type=int, default=10, help="Poses per .rnk ranking.")
+    parser.add_argument("--gmx-latency", type=float, default=0.0, help="Seconds per gmx mdrun call.")
+    parser.add_argument("--gold-utils-latency", type=float, default=0.0, help="Seconds per gold_utils call.")
+    parser.add_argument("--gold-latency", type=float, default=0.0, help="Seconds per gold_auto call.")
+    parser.add_argument("--pipeline", action="store_true", help="Time pipeline.py end to end instead of each script.")
+    parser.add_argument("--workdir", help="Build the campaign here (kept) instead of a temporary directory.")
+    parser.add_argument("--save", help="Write the results as JSON, e.g. to use as --baseline later.")
+    parser.add_argument("--baseline", help="JSON from an earlier --save to compare against.")
+    parser.add_argument("--output", default=output_file)
+    args = parser.parse_args()
+
+    root = args.workdir or tempfile.mkdtemp(prefix="bench_")
+    os.makedirs(root, exist_ok=True)
+    try:
+        bin_dir = os.path.join(root, "bin")
+        os.makedirs(bin_dir, exist_ok=True)
+        write_stub(bin_dir, "gmx", gmx_stub)
+        write_stub(bin_dir, "gold_utils", gold_utils_stub)
+        write_stub(bin_dir, "gold_auto", gold_auto_stub)
+
+        print(f"Generating {args.variants} synthetic variants in {root} ...")
+        monomers = make_campaign(root, args.variants, args.unconverged)
+
+        calls_path = os.path.join(root, "calls.jsonl")
+        env = dict(os.environ,
+                   PATH=bin_dir + os.pathsep + os.environ.get("PATH", ""),
+                   PYTHONPATH=scripts_dir,
+                   BENCH_CALLS=calls_path,
+                   BENCH_GMX_LATENCY=str(args.gmx_latency),
+                   BENCH_GOLD_UTILS_LATENCY=str(args.gold_utils_latency),
+                   BENCH_GOLD_LATENCY=str(args.gold_latency),
+                   BENCH_POSES=str(args.poses))
+
+        if args.pipeline:
+            commands = [("pipeline", pipeline_command(root, monomers, bin_dir, args.jobs))]
+        else:
+            commands = stage_commands(root, monomers, bin_dir, args.jobs)
+
+        results = []
+        for name, command in commands:
+            print(f"⏱️  {name} ...")
+            results.append(run_stage(name, command, root, env, calls_path, args.variants))
+            if not results[-1]["ok"]:
+                print(f"[ERROR] {name} failed; see {results[-1]['log']}")
+
+        baseline = None
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        report = format_report(results, args, baseline)
+        print("\n" + report)
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+        if args.save:
+            with open(args.save, "w") as f:
+                json.dump({"settings": vars(args), "stages": results}, f, indent=1)
+        return 0 if all(r["ok"] for r in results) else 1
+    finally:
+        if not args.workdir:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
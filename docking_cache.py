@@ -0,0 +1,139 @@
+"""Reuse GOLD results for variants whose pocket is the same.
+
+Point mutations far from the active site leave the pocket untouched, so docking those
+variants again gives the same answer. A fingerprint is built from what has to match
+exactly:
+  - the pocket atoms: residue and name of every atom of the residues in
+    gold_activesite_aas.txt, read from the protonated protein,
+  - the contents of the ligand files,
+  - the gold.conf settings that affect the result (paths that differ per variant are left
+    out).
+The coordinates of those atoms are compared separately: every docked pocket is kept as
+a candidate under <cache_dir>/<fingerprint>/<candidate>/ (pocket.npy and the result
+directories), and a variant reuses the closest candidate whose atoms all lie within
+`tolerance` Å of its own. Results are hard-linked (or copied) into the variant folder on
+a hit instead of running gold_auto again. Because of the links, result directories must
+be removed, not overwritten in place, before a variant is docked again.
+"""
+import hashlib
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+# Settings that only name per-variant files; their contents are covered separately.
+path_settings = ("protein_datafile", "cavity_file", "directory")
+# Coordinates are written to 0.001 Å; a tolerance of 0 means equal to that precision.
+exact_tolerance = 0.0005
+pocket_file_name = "pocket.npy"
+
+
+def _file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def pocket_atoms(protein_pdb, activesite_file):
+    """(resn+resi, atom name, x, y, z) of every atom in the active-site residues."""
+    with open(activesite_file, "r") as f:
+        tags = set(" ".join(line for line in f if not line.startswith(">")).split())
+    atoms = []
+    with open(protein_pdb, "r") as f:
+        for line in f:
+            if line[:6] not in ("ATOM  ", "HETATM"):
+                continue
+            tag = f"{line[17:20].strip()}{line[22:27].strip()}"
+            if tag in tags:
+                atoms.append((tag, line[12:16].strip(),
+                              float(line[30:38]), float(line[38:46]), float(line[46:54])))
+    # Sorted by residue and name only, so the coordinates of two pockets line up atom by atom.
+    return sorted(atoms, key=lambda atom: atom[:2])
+
+
+def fingerprint(variant_dir, conf):
+    """(key, coords): hash of the exact parts, and the (n, 3) pocket coordinates in the
+    order of the hashed atoms."""
+    h = hashlib.sha256()
+    activesite = os.path.join(variant_dir, conf.settings["cavity_file"])
+    protein = os.path.join(variant_dir, conf.settings["protein_datafile"])
+    atoms = pocket_atoms(protein, activesite)
+    for tag, name, _, _, _ in atoms:
+        h.update(repr((tag, name)).encode())
+    for ligand_file, runs in conf.ligands:
+        h.update(repr((_file_digest(os.path.join(variant_dir, ligand_file)), runs)).encode())
+    for key in sorted(conf.settings):
+        if key not in path_settings:
+            h.update(repr((key, conf.settings[key])).encode())
+    return h.hexdigest(), np.array([atom[2:] for atom in atoms], dtype=float).reshape(-1, 3)
+
+
+def deviation(a, b):
+    """Largest distance in Å between corresponding atoms of two pockets."""
+    return float(np.sqrt(((a - b) ** 2).sum(axis=1)).max()) if len(a) else 0.0
+
+
+def closest(cache_dir, key, coords, tolerance, names=()):
+    """Path of the candidate nearest to coords within tolerance that holds every result
+    directory in names, or None."""
+    entry = os.path.join(cache_dir, key)
+    if not os.path.isdir(entry):
+        return None
+    best = None
+    for candidate in sorted(os.listdir(entry)):
+        path = os.path.join(entry, candidate)
+        if candidate.startswith(".") or not all(os.path.isdir(os.path.join(path, n)) for n in names):
+            continue
+        try:
+            stored = np.load(os.path.join(path, pocket_file_name))
+        except (OSError, ValueError):
+            continue
+        if stored.shape != coords.shape:
+            continue
+        d = deviation(stored, coords)
+        if d <= max(tolerance, exact_tolerance) and (best is None or d < best[0]):
+            best = (d, path)
+    return best[1] if best else None
+
+
+def _link_tree(src, dst):
+    """Hard-link src into dst, falling back to a copy across filesystems."""
+    def link_or_copy(s, d):
+        try:
+            os.link(s, d)
+        except OSError:
+            shutil.copy2(s, d)
+    shutil.copytree(src, dst, copy_function=link_or_copy, dirs_exist_ok=True)
+
+
+def restore(cache_dir, key, coords, tolerance, result_dirs):
+    """Put the results of the closest cached pocket into result_dirs; returns the
+    candidate's name, or None if no candidate lies within tolerance Å."""
+    names = [os.path.basename(d) for d in result_dirs]
+    candidate = closest(cache_dir, key, coords, tolerance, names)
+    if candidate is None:
+        return None
+    for name, result_dir in zip(names, result_dirs):
+        if os.path.isdir(result_dir):
+            shutil.rmtree(result_dir)
+        _link_tree(os.path.join(candidate, name), result_dir)
+    return os.path.basename(candidate)
+
+
+def store(cache_dir, key, coords, result_dirs):
+    """Save a copy of a finished variant's pocket and result directories as a candidate."""
+    names = [os.path.basename(d) for d in result_dirs]
+    if closest(cache_dir, key, coords, 0.0, names) is not None:
+        return
+    entry = os.path.join(cache_dir, key)
+    candidate = uuid.uuid4().hex
+    # Built under a hidden name and renamed, so a half-written candidate is never matched.
+    tmp = os.path.join(entry, f".{candidate}")
+    os.makedirs(tmp)
+    np.save(os.path.join(tmp, pocket_file_name), coords)
+    for result_dir in result_dirs:
+        shutil.copytree(result_dir, os.path.join(tmp, os.path.basename(result_dir)))
+    os.rename(tmp, os.path.join(entry, candidate))
@@ -0,0 +1,97 @@
+"""In-memory gold.conf templates.
+
+The template is parsed once into named fields; each variant's configuration is rendered
+from it with per-variant overrides and written in a single operation.
+
+Settings are the "key = value" lines of the file. Ligands are the
+"ligand_data_file <file> <number of GA runs>" lines, exposed as a list of
+(file, runs) pairs under the key "ligand_data_file". Everything else (section titles,
+blank lines) is kept verbatim.
+
+A variant can also be docked one ligand at a time: 4-docking_prep.py --shard-ligands writes
+one gold_<ligand>.conf per ligand next to gold.conf, each listing only that ligand.
+"""
+import os
+
+# Keys every rendered configuration must define before docking can start.
+required_keys = ("protein_datafile", "cavity_file", "ligand_data_file")
+
+
+class GoldConfError(ValueError):
+    pass
+
+
+def ligand_stem(ligand_file):
+    """Ligand name as GOLD uses it for its <stem>_m1 result folder."""
+    return os.path.splitext(os.path.basename(ligand_file))[0]
+
+
+def shard_conf_name(stem):
+    return f"gold_{stem}.conf"
+
+
+class GoldConf:
+    def __init__(self, text):
+        self.entries = []
+        self.settings = {}
+        self.ligands = []
+        for line in text.splitlines():
+            stripped = line.strip()
+            if stripped.startswith("ligand_data_file") and "=" not in stripped:
+                parts = stripped.split()
+                runs = int(parts[2]) if len(parts) > 2 else 1
+                if not self.ligands:
+                    self.entries.append(("ligands", None))
+                self.ligands.append((parts[1], runs))
+            elif "=" in stripped and not stripped.startswith("#"):
+                key, value = (s.strip() for s in stripped.split("=", 1))
+                self.entries.append(("setting", key))
+                self.settings[key] = value
+            else:
+                self.entries.append(("raw", line))
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, "r") as f:
+            return cls(f.read())
+
+    def merged(self, overrides=None):
+        """Settings and ligands after applying overrides, checked against the template.
+
+        overrides maps setting names to values; "ligand_data_file" takes a list of
+        (file, runs) pairs and "ga_runs" sets the number of GA runs of every ligand.
+        """
+        overrides = dict(overrides or {})
+        settings = dict(self.settings)
+        ligands = [tuple(lig) for lig in overrides.pop("ligand_data_file", self.ligands)]
+        ga_runs = overrides.pop("ga_runs", None)
+        if ga_runs is not None:
+            ligands = [(name, int(ga_runs)) for name, _ in ligands]
+
+        unknown = [key for key in overrides if key not in settings]
+        if unknown:
+            raise GoldConfError(f"keys not present in the template: {', '.join(unknown)}")
+        settings.update({key: str(value) for key, value in overrides.items()})
+
+        missing = [key for key in required_keys
+                   if (not ligands if key == "ligand_data_file" else key not in settings)]
+        if missing:
+            raise GoldConfError(f"missing required keys: {', '.join(missing)}")
+        return settings, ligands
+
+    def render(self, overrides=None):
+        settings, ligands = self.merged(overrides)
+        out = []
+        for kind, value in self.entries:
+            if kind == "setting":
+                out.append(f"{value} = {settings[value]}")
+            elif kind == "ligands":
+                out.extend(f"ligand_data_file {name} {runs}" for name, runs in ligands)
+            else:
+                out.append(value)
+        return "\n".join(out) + "\n"
+
+    def write(self, path, overrides=None):
+        text = self.render(overrides)
+        with open(path, "w") as f:
+            f.write(text)
@@ -0,0 +1,227 @@
+"""Cooperative work distribution over a shared filesystem.
+
+Any number of worker processes, on any number of hosts, can work through the same
+monomers tree. A worker claims a variant by creating a lease file next to it with
+O_CREAT | O_EXCL, which only one process can win (also on NFSv3+). While the work runs, a
+heartbeat thread refreshes the lease mtime; a lease whose mtime is older than the TTL
+belongs to a dead worker and is taken over. Keep the TTL well above the clock skew
+between hosts.
+
+A worker whose lease was taken over while it worked (it stalled past the TTL) must not
+record its result: work functions check lease_lost() before writing any outcome, and
+cooperative_map drops the result. Tools started for the work are handed to
+stop_on_lease_lost(), so the heartbeat terminates them as soon as the loss is seen instead
+of letting them write into the folder the new holder is working in.
+"""
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+lease_ttl = 300.0
+
+# The lease held by the pool thread running work(name) in cooperative_map.
+_current = threading.local()
+
+
+class Lease:
+    def __init__(self, path, owner, ttl):
+        self.path = path
+        self.owner = owner
+        self.ttl = ttl
+        self.lost = False
+        self._processes = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._heartbeat, daemon=True)
+        self._thread.start()
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.ttl / 3):
+            if not self.held():
+                print(f"[WARNING] Lease {self.path} was taken over by another worker.")
+                self._lose()
+                return
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                self._lose()
+                return
+
+    def _lose(self):
+        with self._lock:
+            self.lost = True
+            processes, self._processes = self._processes, []
+        for proc in processes:
+            _stop_process(proc)
+
+    def watch(self, proc):
+        """Terminate proc as soon as the lease is found lost."""
+        with self._lock:
+            if not self.lost:
+                self._processes.append(proc)
+                return
+        _stop_process(proc)
+
+    def check(self):
+        """False once the lease has been lost or taken over."""
+        if not self.lost and not self.held():
+            self._lose()
+        return not self.lost
+
+    def held(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f).get("owner") == self.owner
+        except (OSError, ValueError):
+            return False
+
+    def release(self):
+        self._stop.set()
+        self._thread.join()
+        if self.held():
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+def _stop_process(proc, grace=30.0):
+    # The work thread waiting on proc reaps it (and sets returncode); it is not waited on
+    # here, so that its resource usage is still accounted for.
+    deadline = time.monotonic() + grace
+    try:
+        if proc.returncode is None:
+            proc.terminate()
+        while proc.returncode is None:
+            if time.monotonic() > deadline:
+                proc.kill()
+                return
+            time.sleep(0.1)
+    except OSError:
+        pass
+
+
+def _create(path, owner):
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, "w") as f:
+        json.dump({"owner": owner, "host": socket.gethostname(), "pid": os.getpid(),
+                   "claimed": time.time()}, f)
+    return True
+
+
+def _read_owner(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f).get("owner")
+    except (OSError, ValueError):
+        return None
+
+
+def lease_lost():
+    """True if the calling work thread's lease was lost (False outside cooperative_map)."""
+    lease = getattr(_current, "lease", None)
+    return lease is not None and not lease.check()
+
+
+def stop_on_lease_lost(proc):
+    """Have the calling work thread's lease terminate proc if lost (no-op outside cooperative_map)."""
+    lease = getattr(_current, "lease", None)
+    if lease is not None:
+        lease.watch(proc)
+
+
+def try_claim(path, ttl=None):
+    """Claim the lease at path; returns a Lease, or None if another live worker holds it."""
+    ttl = lease_ttl if ttl is None else ttl
+    owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+    if _create(path, owner):
+        return Lease(path, owner, ttl)
+    try:
+        expired_owner = _read_owner(path)
+        mtime = os.stat(path).st_mtime
+        age = time.time() - mtime
+    except FileNotFoundError:
+        age = None
+    if age is not None and age < ttl:
+        return None
+    if age is not None:
+        # Expired: move it aside first. Only one of several competing workers wins the rename.
+        stale = f"{path}.stale.{uuid.uuid4().hex}"
+        try:
+            os.rename(path, stale)
+        except FileNotFoundError:
+            return None
+        # Another worker may have reclaimed it between our stat and the rename, so what we
+        # moved may be its fresh lease: put that back (without replacing a newer one).
+        try:
+            moved_mtime = os.stat(stale).st_mtime
+        except FileNotFoundError:
+            return None
+        if _read_owner(stale) != expired_owner or moved_mtime != mtime:
+            try:
+                os.link(stale, path)
+            except OSError:
+                pass
+            os.remove(stale)
+            return None
+        os.remove(stale)
+        print(f"[INFO] Reclaimed expired lease {path} ({age:.0f} s old).")
+    return Lease(path, owner, ttl) if _create(path, owner) else None
+
+
+def _run_leased(work, name, lease):
+    _current.lease = lease
+    try:
+        return work(name)
+    finally:
+        _current.lease = None
+
+
+def cooperative_map(names, lease_path, is_done, work, slots, ttl=None, poll=10.0):
+    """Run work(name) for every name that is not done, holding its lease while it runs.
+
+    Names held by other workers are retried until they are done or their lease expires,
+    so the call returns only when the whole list has been handled by someone.
+    Yields (name, result) for the names processed by this worker, as they finish.
+    """
+    pending = list(names)
+    running = {}
+    with ThreadPoolExecutor(max_workers=slots) as pool:
+        while pending or running:
+            for name in list(pending):
+                if len(running) >= slots:
+                    break
+                if is_done(name):
+                    pending.remove(name)
+                    continue
+                lease = try_claim(lease_path(name), ttl)
+                if lease is None:
+                    continue
+                pending.remove(name)
+                # Another worker may have finished it between our check and the claim.
+                if is_done(name):
+                    lease.release()
+                    continue
+                running[pool.submit(_run_leased, work, name, lease)] = (name, lease)
+
+            if not running:
+                time.sleep(poll)
+                continue
+            finished, _ = wait(running, timeout=poll, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name, lease = running.pop(future)
+                held = lease.check()
+                lease.release()
+                result = future.result()
+                if not held:
+                    # The worker that took the lease over processes it and records the outcome.
+                    print(f"[WARNING] Lost the lease of {name} while working on it; result discarded.")
+                    continue
+                yield name, result
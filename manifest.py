@@ -0,0 +1,210 @@
+"""Shared list of variants and of what every stage has produced for them.
+
+One SQLite file, <monomers>/variants.db, replaces the directory scans each script used to
+make (which are slow on NFS and did not all use the same pattern). It is created by
+0-create_folders.sh, or by the first script that finds it missing, and every stage writes
+what it learnt about a variant into it: Fmax and best replica, pocket centroid, docking
+status, and the SHA-256 of the files it wrote.
+
+    python manifest.py ./monomers            # (re)scan the folders into the manifest
+    python manifest.py ./monomers --list     # print the manifest
+
+Folders added by hand after the manifest exists are only seen after a rescan. Writes go
+through short transactions with a generous busy timeout, so several stages and worker
+processes on one host can share the file; a manifest that cannot be written only prints a
+warning. SQLite locking is not reliable over NFS, so workers on several hosts must not
+write the same manifest: 5-docking.py --cooperative leaves it alone (writes_enabled) and
+keeps the docking state in the per-variant .docking_state*.json files only.
+"""
+import argparse
+import datetime
+import hashlib
+import os
+import sqlite3
+from contextlib import closing
+
+manifest_name = "variants.db"
+busy_timeout = 60.0
+
+schema = """
+CREATE TABLE IF NOT EXISTS variants (
+    name TEXT PRIMARY KEY,
+    variant_id TEXT NOT NULL,
+    path TEXT NOT NULL,
+    fmax REAL,
+    best_replica TEXT,
+    centroid_x REAL,
+    centroid_y REAL,
+    centroid_z REAL,
+    prep_status TEXT,
+    docking_status TEXT,
+    docking_seconds REAL,
+    updated TEXT
+);
+CREATE TABLE IF NOT EXISTS artifacts (
+    variant TEXT NOT NULL REFERENCES variants(name),
+    name TEXT NOT NULL,
+    sha256 TEXT,
+    size INTEGER,
+    mtime_ns INTEGER,
+    PRIMARY KEY (variant, name)
+);
+"""
+
+# Set to False by workers that share the campaign with other hosts (see above).
+writes_enabled = True
+
+variant_fields = ("fmax", "best_replica", "centroid_x", "centroid_y", "centroid_z",
+                  "prep_status", "docking_status", "docking_seconds")
+
+
+def is_variant_dir_name(name):
+    return name.startswith("Variant") and name.endswith("_monomer")
+
+
+def manifest_path(monomers_dir):
+    return os.path.join(monomers_dir, manifest_name)
+
+
+def connect(monomers_dir):
+    conn = sqlite3.connect(manifest_path(monomers_dir), timeout=busy_timeout)
+    conn.executescript(schema)
+    return conn
+
+
+def _now():
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+
+def scan(monomers_dir):
+    """Register every Variant*_monomer folder; returns the number of folders found."""
+    names = sorted(
+        d for d in os.listdir(monomers_dir)
+        if is_variant_dir_name(d) and os.path.isdir(os.path.join(monomers_dir, d))
+    )
+    with closing(connect(monomers_dir)) as conn, conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO variants (name, variant_id, path, updated) VALUES (?, ?, ?, ?)",
+            [(d, d[len("Variant"):-len("_monomer")], d, _now()) for d in names],
+        )
+        # Folders that were removed since the last scan.
+        conn.execute(f"DELETE FROM artifacts WHERE variant NOT IN ({','.join('?' * len(names))})", names)
+        conn.execute(f"DELETE FROM variants WHERE name NOT IN ({','.join('?' * len(names))})", names)
+    return len(names)
+
+
+def _connect_scanned(monomers_dir):
+    """Connection to the manifest, registering every folder first if it does not exist yet.
+
+    Without the scan, a single-variant run would create a manifest holding only that
+    variant, and variant_dirs() would then hide all the others.
+    """
+    if not os.path.exists(manifest_path(monomers_dir)):
+        scan(monomers_dir)
+    return connect(monomers_dir)
+
+
+def variant_dirs(monomers_dir):
+    """Every registered variant folder, sorted by name; scans once if there is no manifest."""
+    if not os.path.isdir(monomers_dir):
+        return []
+    if not os.path.exists(manifest_path(monomers_dir)):
+        try:
+            scan(monomers_dir)
+        except sqlite3.Error as e:
+            print(f"[WARNING] Could not create {manifest_path(monomers_dir)}: {e}; scanning the folder instead.")
+            return sorted(
+                os.path.join(monomers_dir, d) for d in os.listdir(monomers_dir)
+                if is_variant_dir_name(d) and os.path.isdir(os.path.join(monomers_dir, d))
+            )
+    with closing(connect(monomers_dir)) as conn:
+        rows = conn.execute("SELECT path FROM variants ORDER BY name").fetchall()
+    return [os.path.join(monomers_dir, path) for (path,) in rows]
+
+
+def _locate(variant_dir):
+    variant_dir = os.path.normpath(variant_dir)
+    return os.path.dirname(variant_dir) or ".", os.path.basename(variant_dir)
+
+
+def update(variant_dir, **fields):
+    """Store fields (see variant_fields) for the variant in its folder's manifest."""
+    unknown = set(fields) - set(variant_fields)
+    if unknown:
+        raise ValueError(f"unknown manifest field(s): {', '.join(sorted(unknown))}")
+    if not writes_enabled:
+        return
+    monomers_dir, name = _locate(variant_dir)
+    columns = ", ".join(f"{key} = ?" for key in fields)
+    try:
+        with closing(_connect_scanned(monomers_dir)) as conn, conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO variants (name, variant_id, path, updated) VALUES (?, ?, ?, ?)",
+                (name, name[len("Variant"):-len("_monomer")], name, _now()),
+            )
+            conn.execute(f"UPDATE variants SET {columns}, updated = ? WHERE name = ?",
+                         list(fields.values()) + [_now(), name])
+    except sqlite3.Error as e:
+        print(f"[WARNING] Could not update the manifest for {name}: {e}")
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def record_artifacts(variant_dir, paths):
+    """Hash the given files of a variant (paths inside its folder) into the manifest."""
+    if not writes_enabled:
+        return
+    monomers_dir, name = _locate(variant_dir)
+    rows = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            digest = file_sha256(path)
+        except FileNotFoundError:
+            continue
+        rows.append((name, os.path.relpath(path, variant_dir), digest, st.st_size, st.st_mtime_ns))
+    try:
+        with closing(_connect_scanned(monomers_dir)) as conn, conn:
+            conn.executemany("INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?)", rows)
+    except sqlite3.Error as e:
+        print(f"[WARNING] Could not record artifacts of {name} in the manifest: {e}")
+
+
+def artifacts(variant_dir, suffix=""):
+    """{relative path: sha256} of the recorded files whose name ends with suffix."""
+    monomers_dir, name = _locate(variant_dir)
+    with closing(_connect_scanned(monomers_dir)) as conn:
+        rows = conn.execute("SELECT name, sha256 FROM artifacts WHERE variant = ? AND name LIKE ? ORDER BY name",
+                            (name, f"%{suffix}")).fetchall()
+    return dict(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or show the variant manifest.")
+    parser.add_argument("monomers_dir", nargs="?", default=".")
+    parser.add_argument("--list", action="store_true", help="Print the manifest instead of rescanning.")
+    args = parser.parse_args()
+
+    if not args.list:
+        n = scan(args.monomers_dir)
+        print(f"📇 {n} variant(s) registered in {manifest_path(args.monomers_dir)}")
+        return
+
+    with closing(connect(args.monomers_dir)) as conn:
+        rows = conn.execute("SELECT name, fmax, best_replica, centroid_x, centroid_y, centroid_z, "
+                            "prep_status, docking_status FROM variants ORDER BY name").fetchall()
+    print(f"{'Variant':<40} {'Fmax':>10} {'Replica':<8} {'Centroid':<26} {'Prep':<8} {'Docking':<8}")
+    for name, fmax, replica, x, y, z, prep, docking in rows:
+        fmax = f"{fmax:.2f}" if fmax is not None else "-"
+        centroid = f"{x:.2f} {y:.2f} {z:.2f}" if x is not None else "-"
+        print(f"{name:<40} {fmax:>10} {replica or '-':<8} {centroid:<26} {prep or '-':<8} {docking or '-':<8}")
+
+
+if __name__ == "__main__":
+    main()
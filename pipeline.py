@@ -0,0 +1,428 @@
+"""Run the whole workflow, stages 0 to 6, as one incremental campaign.
+
+Every per-variant stage declares the files it reads and the files it writes, relative to
+the variant folder. When a stage succeeds for a variant, the size and mtime of its inputs
+(taken after the run, since 2-filter_minimization.py rewrites its own inputs) are stored in
+<variant>/.pipeline_state.json. A (stage, variant) pair is run again only when one of its
+outputs is missing or one of its inputs has changed since, so editing gold.conf redoes
+preparation and docking but not minimization.
+
+Each variant moves on to its next stage as soon as the previous one finishes. Every stage
+has its own slots, so one variant can be docking while another is still minimizing:
+
+    python pipeline.py --monomers-dir ./monomers --em-jobs 4 --dock-slots 8
+    python pipeline.py --dry-run            # only list the stale stages
+
+The stages run as the usual scripts, one variant per call; their output goes to
+<variant>/pipeline_<stage>.log. Stage 0 (folder creation) runs first if loose PDB files
+are found, and stage 6 (results.xlsx) once every variant has been handled.
+"""
+import argparse
+import glob
+import json
+import os
+import queue
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import manifest
+import profiling
+from gold_conf import GoldConf, ligand_stem, shard_conf_name
+from proc_stream import run_logged
+
+monomers_dir = "./monomers"
+reference_pdb = "6v2a_monomer.pdb"
+template_conf = "gold.conf"
+overrides_file = "gold_overrides.json"
+results_file = "results.xlsx"
+
+state_file_name = ".pipeline_state.json"
+scripts_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+class Stage:
+    """One per-variant step: the command that runs it and the files it reads and writes.
+
+    inputs and outputs are functions of the variant folder returning paths (inputs may be
+    glob patterns, each of which has to match at least one file). shared_inputs are files
+    outside the variant folder, such as the reference PDB; they may be missing. options
+    are command-line settings that change what the stage writes; changing them makes
+    the stage stale like a changed input.
+    """
+
+    def __init__(self, name, command, inputs, outputs, slots=1, shared_inputs=(), options=()):
+        self.name = name
+        self.command = command
+        self.inputs = inputs
+        self.outputs = outputs
+        self.shared_inputs = shared_inputs
+        self.options = list(options)
+        self.slots = queue.Queue()
+        for slot in range(slots):
+            self.slots.put(slot)
+        self.n_slots = slots
+
+
+def variant_id(variant_dir):
+    return os.path.basename(os.path.normpath(variant_dir)).split("Variant")[1].split("_monomer")[0]
+
+
+def in_variant(*patterns):
+    def paths(variant_dir):
+        return [os.path.join(variant_dir, p.format(id=variant_id(variant_dir))) for p in patterns]
+    return paths
+
+
+def variant_conf(variant_dir):
+    try:
+        return GoldConf.from_file(os.path.join(variant_dir, template_conf))
+    except (OSError, ValueError):
+        return None
+
+
+def docking_inputs(variant_dir):
+    paths = in_variant(template_conf, "EM_Variant{id}_monomer_H.pdb", "gold_activesite_aas.txt")(variant_dir)
+    conf = variant_conf(variant_dir)
+    if conf is not None:
+        paths += [os.path.join(variant_dir, ligand_file) for ligand_file, _ in conf.ligands]
+        # Per-ligand confs, when the prep stage wrote them (--shard-ligands).
+        shards = [os.path.join(variant_dir, shard_conf_name(ligand_stem(f))) for f, _ in conf.ligands]
+        paths += [p for p in shards if os.path.exists(p)]
+    return paths
+
+
+def docking_outputs(variant_dir):
+    # Same layout as expected_outputs() in 5-docking.py.
+    conf = variant_conf(variant_dir)
+    if conf is None:
+        return [os.path.join(variant_dir, template_conf)]
+    out_dir = os.path.join(variant_dir, conf.settings.get("directory", "."))
+    outputs = []
+    for ligand_file, _ in conf.ligands:
+        stem = ligand_stem(ligand_file)
+        outputs.append(os.path.normpath(os.path.join(out_dir, f"{stem}_m1", f"{stem}_m1.rnk")))
+    return outputs
+
+
+def script(name):
+    return [sys.executable, os.path.join(scripts_dir, name)]
+
+
+def build_stages(args):
+    cores = os.cpu_count() or 1
+    em_threads = args.em_threads or min(4, cores)
+    em_jobs = args.em_jobs or max(1, cores // em_threads)
+    monomers = args.monomers_dir
+
+    def minimization(variant_dir, slot):
+        return script("1-minimization.py") + [
+            variant_dir, "-j", "1", "-t", str(em_threads), "--pinoffset", str(slot * em_threads)
+        ]
+
+    def filtering(variant_dir, slot):
+        return script("2-filter_minimization.py") + [variant_dir, "--base-dir", monomers]
+
+    def centroid(variant_dir, slot):
+        return script("3-find_centroid.py") + [
+            variant_dir, "--monomers-dir", monomers, "--reference", args.reference,
+            "--images", args.images, "--render-workers", "1"
+        ]
+
+    prep_options = (["--ligands"] + args.ligands if args.ligands else []) + (["--shard-ligands"] if args.shard_ligands else [])
+
+    def preparation(variant_dir, slot):
+        command = script("4-docking_prep.py") + [
+            variant_dir, "--monomers-dir", monomers, "--template", args.template, "-j", "1"
+        ] + prep_options
+        return command + (["--gold-utils", args.gold_utils] if args.gold_utils else [])
+
+    def docking(variant_dir, slot):
+        command = script("5-docking.py") + [
+            os.path.basename(os.path.normpath(variant_dir)), "--base-dir", monomers,
+            "-n", str(args.ligand_slots), "--restart"
+        ]
+        if args.gold_auto:
+            command += ["--gold-auto", args.gold_auto]
+        if args.cache:
+            command += ["--cache", "--cache-tolerance", str(args.cache_tolerance)]
+        return command
+
+    template_dir = os.path.dirname(os.path.abspath(args.template))
+    return [
+        Stage("minimization", minimization,
+              in_variant("EM.mdp", "box_solv_ion.gro", "topol.top"), in_variant("EM.log"),
+              slots=em_jobs),
+        Stage("filter", filtering, in_variant("EM*.log"), in_variant("forces_summary.txt"),
+              slots=args.jobs),
+        Stage("centroid", centroid,
+              in_variant("EM_Variant{id}_monomer.pdb"),
+              in_variant("coordinates.txt", "gold_activesite_aas.txt"),
+              slots=args.jobs, shared_inputs=(args.reference,)),
+        Stage("prep", preparation,
+              in_variant("EM_Variant{id}_monomer.pdb", "gold_activesite_aas.txt"),
+              in_variant(template_conf, "EM_Variant{id}_monomer_H.pdb"),
+              slots=args.jobs, shared_inputs=(args.template, os.path.join(template_dir, overrides_file)),
+              options=prep_options),
+        Stage("docking", docking, docking_inputs, docking_outputs, slots=args.dock_slots),
+    ]
+
+
+def signature(paths, root):
+    # Keyed relative to the variant folder, so a moved campaign is not redone from scratch.
+    sig = {}
+    for path in paths:
+        key = os.path.relpath(path, root)
+        try:
+            st = os.stat(path)
+            sig[key] = [st.st_size, st.st_mtime_ns]
+        except FileNotFoundError:
+            sig[key] = None
+    return sig
+
+
+def expand_inputs(stage, variant_dir):
+    """Input files of the stage, or (None, pattern) when a required input is missing."""
+    paths = []
+    for pattern in stage.inputs(variant_dir):
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            return None, pattern
+        paths += matches
+    return paths + list(stage.shared_inputs), None
+
+
+def load_state(variant_dir):
+    try:
+        with open(os.path.join(variant_dir, state_file_name), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_state(variant_dir, stage_name, record):
+    # Only the thread that just finished this variant's stage writes its file.
+    path = os.path.join(variant_dir, state_file_name)
+    state = dict(load_state(variant_dir), **{stage_name: record})
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def check_stage(stage, variant_dir, forced=()):
+    """('stale' | 'fresh' | 'blocked', reason)."""
+    inputs, missing = expand_inputs(stage, variant_dir)
+    if inputs is None:
+        return "blocked", f"missing input {os.path.relpath(missing, variant_dir)}"
+    if stage.name in forced:
+        return "stale", "forced"
+    record = load_state(variant_dir).get(stage.name)
+    if record is None:
+        return "stale", "never run"
+    if record.get("failed"):
+        return "stale", "failed last time"
+    if record.get("options", []) != stage.options:
+        return "stale", "options changed"
+    for path in stage.outputs(variant_dir):
+        if not os.path.exists(path):
+            return "stale", f"missing output {os.path.relpath(path, variant_dir)}"
+    if record.get("inputs") != signature(inputs, variant_dir):
+        return "stale", "inputs changed"
+    return "fresh", None
+
+
+def run_stage(stage, variant_dir):
+    slot = stage.slots.get()
+    started = time.monotonic()
+    try:
+        command = stage.command(variant_dir, slot)
+        log_path = os.path.join(variant_dir, f"pipeline_{stage.name}.log")
+        run_logged(command, log_path, profile_name=f"stage {stage.name}")
+        missing = [p for p in stage.outputs(variant_dir) if not os.path.exists(p)]
+        if missing:
+            return False, time.monotonic() - started, f"no {os.path.relpath(missing[0], variant_dir)} (see {log_path})"
+        return True, time.monotonic() - started, None
+    except subprocess.CalledProcessError as e:
+        return False, time.monotonic() - started, f"exit code {e.returncode}:\n{e.stderr}"
+    except OSError as e:
+        return False, time.monotonic() - started, str(e)
+    finally:
+        stage.slots.put(slot)
+
+
+def run_pipeline(variant_dirs, stages, forced=(), dry_run=False):
+    """Drive every variant through the stages; returns {variant_dir: final status}."""
+    outcome = {}
+    ran = {stage.name: 0 for stage in stages}
+    executors = {stage.name: ThreadPoolExecutor(max_workers=stage.n_slots) for stage in stages}
+    running = {}
+
+    def advance(variant_dir, start):
+        # Skip fresh stages and submit the first stale one. A stage that rewrote its outputs
+        # makes the next one stale through its input signature; one that left them alone
+        # (e.g. an already converged minimization) does not.
+        name = os.path.basename(variant_dir)
+        for i in range(start, len(stages)):
+            stage = stages[i]
+            status, reason = check_stage(stage, variant_dir, forced)
+            if status == "fresh":
+                continue
+            if status == "blocked":
+                print(f"[WAIT] {name}: {stage.name} {reason}.")
+                outcome[variant_dir] = f"blocked at {stage.name}"
+                return
+            print(f"[{'PLAN' if dry_run else 'RUN'}] {name}: {stage.name} ({reason})")
+            if dry_run:
+                outcome[variant_dir] = f"stale from {stage.name}"
+                return
+            running[executors[stage.name].submit(run_stage, stage, variant_dir)] = (variant_dir, i)
+            return
+        outcome[variant_dir] = "done" if variant_dir in outcome else "up to date"
+
+    try:
+        for variant_dir in variant_dirs:
+            advance(variant_dir, 0)
+
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                variant_dir, i = running.pop(future)
+                stage = stages[i]
+                ok, elapsed, error = future.result()
+                name = os.path.basename(variant_dir)
+                if not ok:
+                    print(f"[FAILED] {name}: {stage.name} after {elapsed:.0f} s: {error}")
+                    outcome[variant_dir] = f"failed at {stage.name}"
+                    # Old outputs may still be there; make sure the next run tries again.
+                    save_state(variant_dir, stage.name, {"failed": error.splitlines()[0]})
+                    continue
+                inputs, _ = expand_inputs(stage, variant_dir)
+                record = {
+                    "inputs": signature(inputs or [], variant_dir),
+                    "seconds": round(elapsed, 1),
+                    "finished": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                }
+                if stage.options:
+                    record["options"] = stage.options
+                save_state(variant_dir, stage.name, record)
+                ran[stage.name] += 1
+                print(f"[DONE] {name}: {stage.name} in {elapsed:.0f} s")
+                outcome[variant_dir] = "running"
+                advance(variant_dir, i + 1)
+    finally:
+        for executor in executors.values():
+            executor.shutdown(wait=True)
+    return outcome, ran
+
+
+def create_folders(monomers):
+    """Stage 0: move loose PDB files into their own folders."""
+    if not glob.glob(os.path.join(monomers, "*.pdb")):
+        return
+    print(f"[RUN] stage 0: creating variant folders in {monomers}")
+    profiling.run(["bash", os.path.join(scripts_dir, "0-create_folders.sh")], cwd=monomers, check=True,
+                  profile_fields={"name": "stage 0-create_folders"})
+
+
+def collect_results(variant_dirs, stages, args, forced=()):
+    """Stage 6: rebuild the workbook when any docking output is newer than the last build."""
+    docking = stages[-1]
+    rnk_files = sorted(p for d in variant_dirs for p in docking.outputs(d) if os.path.exists(p))
+    record = load_state(args.monomers_dir).get("results")
+    current = signature(rnk_files, args.monomers_dir)
+    if "results" not in forced and os.path.exists(args.output) and record and record.get("inputs") == current:
+        print(f"[OK] {args.output} is up to date.")
+        return
+    if args.dry_run:
+        print(f"[PLAN] results: rebuild {args.output} from {len(rnk_files)} ranking file(s)")
+        return
+    print(f"[RUN] results: {args.output}")
+    command = script("6-generate_xlsx.py") + ["--monomers-dir", args.monomers_dir, "--output", args.output]
+    try:
+        run_logged(command, os.path.join(args.monomers_dir, "pipeline_results.log"), profile_name="stage results")
+    except subprocess.CalledProcessError as e:
+        print(f"[FAILED] results: exit code {e.returncode}:\n{e.stderr}")
+        return
+    save_state(args.monomers_dir, "results", {"inputs": current})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run stages 0-6 for every variant, redoing only what is out of date.")
+    parser.add_argument("variants", nargs="*", help="Variant folders to process (default: every Variant*_monomer in --monomers-dir).")
+    parser.add_argument("--monomers-dir", default=monomers_dir)
+    parser.add_argument("--reference", default=reference_pdb)
+    parser.add_argument("--template", default=template_conf, help="Template gold.conf used by the preparation stage.")
+    parser.add_argument("--output", default=results_file)
+    parser.add_argument("--gold-utils", help="Path to gold_utils (default: the one set in 4-docking_prep.py).")
+    parser.add_argument("--gold-auto", help="Path to gold_auto (default: the one set in 5-docking.py).")
+    parser.add_argument("--em-jobs", type=int, help="Minimizations run at the same time.")
+    parser.add_argument("--em-threads", type=int, help="mdrun threads per minimization.")
+    parser.add_argument("--dock-slots", type=int, default=os.cpu_count() or 1,
+                        help="Docking jobs kept in flight; match it to your GOLD licence seats.")
+    parser.add_argument("--ligands", nargs="+", metavar="MOL2",
+                        help="Ligand set passed to the preparation stage (default: the template's).")
+    parser.add_argument("--shard-ligands", action="store_true",
+                        help="Prepare one conf per ligand, so every ligand of a variant is docked as its own job.")
+    parser.add_argument("--ligand-slots", type=int, default=1,
+                        help="With --shard-ligands, ligands of one variant docked at the same time (each counts against the licence seats).")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="Slots for the light stages (filter, centroid, prep).")
+    parser.add_argument("--images", choices=["full", "thumbnails", "none"], default="none",
+                        help="centroid_pocket images drawn by the centroid stage.")
+    parser.add_argument("--cache", action="store_true", help="Pass --cache to the docking stage.")
+    parser.add_argument("--cache-tolerance", type=float, default=0.0)
+    parser.add_argument("--force", nargs="+", default=[], metavar="STAGE",
+                        help="Treat these stages as stale for every variant (minimization, filter, centroid, prep, docking, results).")
+    parser.add_argument("--dry-run", action="store_true", help="Only list the stale stages.")
+    parser.add_argument("--profile", metavar="REPORT",
+                        help="Append resource-usage records of every stage and tool to this JSONL file (see profiling.py).")
+    parser.add_argument("--cprofile", metavar="DIR", help="With --profile, also write cProfile dumps of every stage here.")
+    args = parser.parse_args()
+
+    # The stages are separate processes; they pick the settings up from the environment.
+    if args.profile:
+        os.environ[profiling.report_env] = os.path.abspath(args.profile)
+    if args.cprofile:
+        os.environ[profiling.cprofile_env] = os.path.abspath(args.cprofile)
+
+    args.monomers_dir = os.path.abspath(args.monomers_dir)
+    args.reference = os.path.abspath(args.reference)
+    args.template = os.path.abspath(args.template)
+    args.output = os.path.abspath(args.output)
+    # gold_auto runs inside the variant folder; a relative path would no longer resolve there.
+    for tool in ("gold_utils", "gold_auto"):
+        path = getattr(args, tool)
+        if path and os.sep in path:
+            setattr(args, tool, os.path.abspath(path))
+    if not os.path.isdir(args.monomers_dir):
+        print(f"[ERROR] Directory '{args.monomers_dir}' does not exist or is not valid.")
+        return 1
+
+    if not args.dry_run:
+        create_folders(args.monomers_dir)
+    variant_dirs = [os.path.abspath(d) for d in args.variants] or manifest.variant_dirs(args.monomers_dir)
+    if not variant_dirs:
+        print("[ERROR] No variant folders to process.")
+        return 1
+
+    stages = build_stages(args)
+    print(f"[INFO] {len(variant_dirs)} variants; slots: "
+          + ", ".join(f"{stage.name}={stage.n_slots}" for stage in stages))
+    start = time.monotonic()
+    outcome, ran = run_pipeline(variant_dirs, stages, set(args.force), args.dry_run)
+    collect_results(variant_dirs, stages, args, set(args.force))
+
+    if args.profile:
+        print(f"📊 Resource usage recorded in {args.profile}; summarize with: python profiling.py {args.profile}")
+    print(f"\n⏱️  Pipeline finished in {time.monotonic() - start:.0f} s "
+          f"({', '.join(f'{name}: {n} run(s)' for name, n in ran.items())}).")
+    print(f"{'Variant':<40} {'Status':<24}")
+    for variant_dir in variant_dirs:
+        print(f"{os.path.basename(variant_dir):<40} {outcome.get(variant_dir, '-'):<24}")
+    return 1 if any(s.startswith("failed") for s in outcome.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
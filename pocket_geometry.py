@@ -0,0 +1,263 @@
+"""Headless pocket geometry for 3-find_centroid.py.
+
+Structures are read straight from PDB files (or their structure_cache copies) into NumPy
+arrays and the PyMOL steps of the centroid search are reproduced without a PyMOL session:
+the superposition done by cmd.align, the "within 5.0 of" / "within 8 of" selections
+(KD-tree queries) and the CA centroid.
+"""
+import difflib
+import hashlib
+import os
+import uuid
+import zipfile
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Same residues the PyMOL version removed with cmd.remove("resn HOH") / ("resn WAT").
+water_resn = ("HOH", "WAT")
+
+
+class Structure:
+    """Atoms of one PDB model as parallel arrays (waters already removed)."""
+
+    def __init__(self, coords, name, resn, chain, resi, hetatm, res_index=None):
+        self.coords = coords
+        self.name = name
+        self.resn = resn
+        self.chain = chain
+        self.resi = resi
+        self.hetatm = hetatm
+        self._tree = None
+        if res_index is not None:
+            self.res_index = res_index
+            return
+        # Consecutive atoms sharing chain/resi/resn form a residue, as PyMOL's byres does.
+        keys = np.char.add(np.char.add(chain, resi), resn)
+        new_residue = np.ones(len(keys), dtype=bool)
+        new_residue[1:] = keys[1:] != keys[:-1]
+        self.res_index = np.cumsum(new_residue) - 1
+
+    def __len__(self):
+        return len(self.coords)
+
+    @property
+    def polymer(self):
+        return ~self.hetatm
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = cKDTree(self.coords)
+        return self._tree
+
+    def within(self, points, cutoff):
+        """Mask of atoms within cutoff Å of any of the given points."""
+        mask = np.zeros(len(self), dtype=bool)
+        if len(points):
+            hits = cKDTree(points).query_ball_tree(self.tree, cutoff)
+            for idx in hits:
+                mask[idx] = True
+        return mask
+
+    def byres(self, mask):
+        """Extend an atom mask to whole residues."""
+        return np.isin(self.res_index, np.unique(self.res_index[mask]))
+
+    def transformed(self, rotation, translation):
+        moved = Structure.__new__(Structure)
+        moved.__dict__.update(self.__dict__)
+        moved.coords = self.coords @ rotation.T + translation
+        moved._tree = None
+        return moved
+
+
+def load_pdb(path):
+    """Read the first model of a PDB file, skipping waters."""
+    coords, name, resn, chain, resi, hetatm = [], [], [], [], [], []
+    with open(path, "r") as f:
+        for line in f:
+            record = line[:6]
+            if record == "ENDMDL":
+                break
+            if record not in ("ATOM  ", "HETATM"):
+                continue
+            residue = line[17:20].strip()
+            if residue in water_resn:
+                continue
+            coords.append((float(line[30:38]), float(line[38:46]), float(line[46:54])))
+            name.append(line[12:16].strip())
+            resn.append(residue)
+            chain.append(line[21:22].strip())
+            resi.append(line[22:27].strip())
+            hetatm.append(record == "HETATM")
+    return Structure(
+        np.array(coords, dtype=float).reshape(-1, 3),
+        np.array(name, dtype=str),
+        np.array(resn, dtype=str),
+        np.array(chain, dtype=str),
+        np.array(resi, dtype=str),
+        np.array(hetatm, dtype=bool),
+    )
+
+
+def ligand_mask(struct, chain="A", resn="ASN", resi="401"):
+    """Atoms of the selection "hetatm and chain A and resn ASN and resi 401"."""
+    return struct.hetatm & (struct.chain == chain) & (struct.resn == resn) & (struct.resi == resi)
+
+
+def reference_pocket_mask(reference, lig_mask, pocket_cutoff=5.0):
+    """byres (polymer within pocket_cutoff of lig), restricted to the reference itself."""
+    return reference.byres(reference.within(reference.coords[lig_mask], pocket_cutoff) & reference.polymer)
+
+
+def load_reference(pdb_path, cache_dir, pocket_cutoff=5.0, **ligand):
+    """Parsed reference structure with its ligand and pocket masks.
+
+    These never change during a campaign, so they are computed once and stored in
+    cache_dir under a key made from the reference PDB contents and the selection
+    parameters; later runs load the arrays instead of re-parsing the PDB.
+    Returns (structure, lig_mask, pocket_mask).
+    """
+    h = hashlib.sha256()
+    with open(pdb_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    h.update(repr((sorted(ligand.items()), pocket_cutoff)).encode())
+    stem = os.path.splitext(os.path.basename(pdb_path))[0]
+    cache_path = os.path.join(cache_dir, f"{stem}_{h.hexdigest()[:16]}.npz")
+
+    try:
+        with np.load(cache_path) as data:
+            reference = Structure(*(data[k] for k in ("coords", "name", "resn", "chain", "resi", "hetatm")))
+            return reference, data["lig_mask"], data["pocket_mask"]
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        # Missing, or left partial or corrupt by an interrupted run: rebuilt below.
+        pass
+
+    reference = load_pdb(pdb_path)
+    lig_mask = ligand_mask(reference, **ligand)
+    pocket_mask = reference_pocket_mask(reference, lig_mask, pocket_cutoff)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Several centroid stages may build it at once; each writes its own temporary file.
+    tmp_path = f"{cache_path}.{os.getpid()}.{uuid.uuid4().hex}.tmp.npz"
+    np.savez(tmp_path, coords=reference.coords, name=reference.name, resn=reference.resn,
+             chain=reference.chain, resi=reference.resi, hetatm=reference.hetatm,
+             lig_mask=lig_mask, pocket_mask=pocket_mask)
+    os.replace(tmp_path, cache_path)
+    return reference, lig_mask, pocket_mask
+
+
+def pair_atoms(mobile, target):
+    """Pair polymer atoms of two structures the way cmd.align does.
+
+    Residues are matched by a sequence alignment of the two chains, then atoms by name
+    within matched residues, so point mutations and renumbering are tolerated.
+    """
+    def residues(struct):
+        idx = np.flatnonzero(struct.polymer)
+        starts = idx[np.r_[True, struct.res_index[idx][1:] != struct.res_index[idx][:-1]]]
+        return list(struct.res_index[starts]), list(struct.resn[starts])
+
+    m_res, m_seq = residues(mobile)
+    t_res, t_seq = residues(target)
+
+    m_atoms, t_atoms = {}, {}
+    for i in np.flatnonzero(mobile.polymer):
+        m_atoms.setdefault(mobile.res_index[i], {})[mobile.name[i]] = i
+    for i in np.flatnonzero(target.polymer):
+        t_atoms.setdefault(target.res_index[i], {})[target.name[i]] = i
+
+    pairs_m, pairs_t = [], []
+    matcher = difflib.SequenceMatcher(None, m_seq, t_seq, autojunk=False)
+    for block in matcher.get_matching_blocks():
+        for k in range(block.size):
+            a = m_atoms[m_res[block.a + k]]
+            b = t_atoms[t_res[block.b + k]]
+            for atom_name, i in a.items():
+                j = b.get(atom_name)
+                if j is not None:
+                    pairs_m.append(i)
+                    pairs_t.append(j)
+    return np.array(pairs_m, dtype=int), np.array(pairs_t, dtype=int)
+
+
+def kabsch(mobile, target):
+    """Rotation and translation that best map mobile onto target (least squares)."""
+    mc, tc = mobile.mean(axis=0), target.mean(axis=0)
+    h = (mobile - mc).T @ (target - tc)
+    u, _, vt = np.linalg.svd(h)
+    d = np.sign(np.linalg.det(vt.T @ u.T))
+    rotation = vt.T @ np.diag([1.0, 1.0, d]) @ u.T
+    return rotation, tc - mc @ rotation.T
+
+
+def superpose(mobile, target, cycles=5, cutoff=2.0):
+    """Superpose mobile onto target like cmd.align(mobile, target).
+
+    Pairs deviating by more than cutoff x RMSD are rejected for up to `cycles` rounds of
+    refinement. Returns (rotation, translation, rmsd, n_atoms) for the final fit.
+    """
+    idx_m, idx_t = pair_atoms(mobile, target)
+    if len(idx_m) < 3:
+        raise ValueError("fewer than 3 atom pairs shared between the structures")
+    a, b = mobile.coords[idx_m], target.coords[idx_t]
+    for _ in range(cycles + 1):
+        rotation, translation = kabsch(a, b)
+        # Counted before the rejection below, which may run after the last fit.
+        n_atoms = len(a)
+        dev = np.linalg.norm(a @ rotation.T + translation - b, axis=1)
+        rmsd = np.sqrt(np.mean(dev ** 2))
+        keep = dev <= cutoff * rmsd
+        if keep.all() or keep.sum() < 3:
+            break
+        a, b = a[keep], b[keep]
+    return rotation, translation, rmsd, n_atoms
+
+
+def find_pocket(reference, model, lig_mask, ref_pocket=None, pocket_cutoff=5.0, residue_cutoff=8.0):
+    """Locate the active-site pocket of `model` from the ligand in `reference`.
+
+    Mirrors the selections of the original PyMOL script:
+      pocket_6v2a      byres (polymer within 5.0 of lig)        (reference and model)
+      pocket_model     model within 5.0 of pocket_6v2a
+      near_model       byres (polymer and pocket_model)
+      centroid         mean of the near_model CA atoms
+      pocket_residues  byres (model within 8 of centroid) and polymer, CA atoms
+    The reference is moved onto the model, so every coordinate is in the model frame.
+    ref_pocket is the reference part of pocket_6v2a; it is rigid under superposition,
+    so callers can precompute it once with reference_pocket_mask().
+    """
+    rotation, translation, rmsd, n_aligned = superpose(reference, model)
+    ref = reference.transformed(rotation, translation)
+    lig = ref.coords[lig_mask]
+
+    if ref_pocket is None:
+        ref_pocket = reference_pocket_mask(reference, lig_mask, pocket_cutoff)
+    model_pocket = model.byres(model.within(lig, pocket_cutoff) & model.polymer)
+    pocket_xyz = np.vstack([ref.coords[ref_pocket], model.coords[model_pocket]])
+
+    pocket_model = model.within(pocket_xyz, pocket_cutoff)
+    near_model = model.byres(model.polymer & pocket_model)
+    ca = near_model & (model.name == "CA")
+
+    result = {
+        "rmsd": rmsd,
+        "n_aligned": n_aligned,
+        "pocket_atoms": int(ref_pocket.sum() + model_pocket.sum()),
+        "pocket_model_atoms": int(pocket_model.sum()),
+        "near_model_atoms": int(near_model.sum()),
+        "centroid": None,
+        "residues": [],
+    }
+    if not ca.any():
+        return result
+
+    centroid = model.coords[ca].mean(axis=0, dtype=float)
+    near_centroid = model.byres(model.within(centroid[None, :], residue_cutoff)) & model.polymer
+    result["centroid"] = centroid
+    result["residues"] = [
+        (model.resi[i], model.resn[i], *model.coords[i])
+        for i in np.flatnonzero(near_centroid & (model.name == "CA"))
+    ]
+    return result
@@ -0,0 +1,143 @@
+"""Deferred rendering of the centroid_pocket.png images.
+
+3-find_centroid.py only computes coordinates; the pictures are drawn here by a pool of
+worker processes, each with its own PyMOL instance. The stage can also be run on its own
+once the centroids exist:
+
+    python pocket_render.py --mode thumbnails --workers 8
+"""
+import argparse
+import multiprocessing
+import os
+
+import manifest
+import profiling
+
+monomers_dir = "./monomers"
+reference_pdb = "6v2a_monomer.pdb"
+
+# (file name, width, height, dpi) for each mode.
+render_modes = {
+    "full": ("centroid_pocket.png", 2000, 1800, 300),
+    "thumbnails": ("centroid_pocket_thumb.png", 400, 360, 72),
+}
+
+_pymol = None
+
+def _start_worker():
+    global _pymol
+    import pymol2
+    _pymol = pymol2.PyMOL()
+    _pymol.start()
+
+def image_path_for(full_folder, mode):
+    return os.path.join(full_folder, render_modes[mode][0])
+
+def is_current(image_path, pdb_path):
+    """An image newer than the structure it shows does not need to be drawn again."""
+    try:
+        return os.path.getmtime(image_path) >= os.path.getmtime(pdb_path)
+    except FileNotFoundError:
+        return False
+
+def render_image(cmd, ref_pdb, pdb_path, model_name, centroid, image_path, width, height, dpi):
+    cmd.reinitialize()
+    cmd.load(ref_pdb, "6v2a_monomer")
+    cmd.load(pdb_path, model_name)
+    cmd.align("6v2a_monomer", model_name)
+    cmd.remove("resn HOH")
+    cmd.remove("resn WAT")
+    cmd.select("lig", "hetatm and chain A and resn ASN and resi 401")
+    cmd.show("sticks", "lig")
+
+    cmd.pseudoatom("centroid_pocket", pos=[float(c) for c in centroid])
+    cmd.show("spheres", "centroid_pocket")
+    cmd.color("red", "centroid_pocket")
+    cmd.set("sphere_scale", 1.0, "centroid_pocket")
+
+    cmd.show("cartoon", model_name)
+    cmd.color("slate", f"{model_name} and not lig")
+
+    cmd.show("cartoon", "6v2a_monomer")
+    cmd.color("wheat", "6v2a_monomer and not lig")
+
+    cmd.zoom("centroid_pocket", buffer=15)
+
+    cmd.bg_color("white")
+    cmd.set("ray_trace_mode", 1)
+    cmd.set("antialias", 2)
+    cmd.set("ray_shadows", 0)
+    cmd.set("ray_trace_gain", 0.1)
+    cmd.set("ray_trace_disco_factor", 1)
+    cmd.set("ray_trace_fog", 0.5)
+
+    cmd.color("yellow", "lig")
+    cmd.rebuild()
+    cmd.refresh()
+
+    cmd.png(image_path, width=width, height=height, dpi=dpi, ray=0)
+
+def _render_job(job):
+    ref_pdb, pdb_path, model_name, centroid, mode = job
+    _, width, height, dpi = render_modes[mode]
+    image_path = image_path_for(os.path.dirname(pdb_path), mode)
+    try:
+        with profiling.span("render_image", variant=os.path.basename(os.path.dirname(pdb_path)), mode=mode):
+            render_image(_pymol.cmd, ref_pdb, pdb_path, model_name, centroid, image_path, width, height, dpi)
+        return image_path, None
+    except Exception as e:
+        return image_path, str(e)
+
+def render_all(jobs, mode, workers=None, ref_pdb=reference_pdb):
+    """Render (pdb_path, model_name, centroid) jobs, skipping images that are up to date."""
+    if mode == "none":
+        return
+    pending = [
+        (ref_pdb, pdb_path, model_name, centroid, mode)
+        for pdb_path, model_name, centroid in jobs
+        if not is_current(image_path_for(os.path.dirname(pdb_path), mode), pdb_path)
+    ]
+    skipped = len(jobs) - len(pending)
+    if skipped:
+        print(f"{skipped} image(s) already newer than their PDB; skipping.")
+    if not pending:
+        return
+
+    workers = min(workers or os.cpu_count() or 1, len(pending))
+    print(f"Rendering {len(pending)} image(s) ({mode}) with {workers} PyMOL worker(s)...")
+    with multiprocessing.Pool(workers, initializer=_start_worker) as pool:
+        for image_path, error in pool.imap_unordered(_render_job, pending):
+            if error:
+                print(f"Error rendering {image_path}: {error}")
+            else:
+                print(f"Image saved: {image_path}")
+
+def read_centroid(coordinates_path):
+    with open(coordinates_path, "r") as f:
+        f.readline()
+        return [float(v) for v in f.readline().split()]
+
+def main():
+    parser = argparse.ArgumentParser(description="Render centroid_pocket images for every variant.")
+    parser.add_argument("--monomers-dir", default=monomers_dir)
+    parser.add_argument("--mode", choices=sorted(render_modes), default="full")
+    parser.add_argument("--workers", type=int, help="Number of PyMOL worker processes (default: all cores).")
+    args = parser.parse_args()
+
+    jobs = []
+    for full_folder in manifest.variant_dirs(args.monomers_dir):
+        folder = os.path.basename(full_folder)
+        variant = folder.split("Variant")[1].split("_monomer")[0]
+        model_name = f"EM_Variant{variant}_monomer"
+        pdb_path = os.path.join(full_folder, f"{model_name}.pdb")
+        coordinates_path = os.path.join(full_folder, "coordinates.txt")
+        if not (os.path.exists(pdb_path) and os.path.exists(coordinates_path)):
+            print(f"Skipping {folder}: PDB or coordinates.txt missing (run 3-find_centroid.py first).")
+            continue
+        jobs.append((pdb_path, model_name, read_centroid(coordinates_path)))
+
+    render_all(jobs, args.mode, args.workers)
+
+if __name__ == "__main__":
+    with profiling.stage("pocket_render"):
+        main()
@@ -0,0 +1,54 @@
+"""Run external tools with their output streamed to rotating log files.
+
+GOLD and gold_utils can print a lot; instead of holding it in memory until the process
+exits (capture_output=True), every line goes straight to a per-variant log file and only
+the last few lines are kept for error reports.
+"""
+import collections
+import logging
+import logging.handlers
+import os
+import subprocess
+
+import profiling
+
+tail_lines = 40
+log_max_bytes = 10 * 1024 * 1024
+log_backups = 3
+
+
+def run_logged(cmd, log_path, cwd=None, on_line=None, profile_name=None, on_start=None):
+    """Run cmd, appending its combined stdout/stderr to log_path (rotated at log_max_bytes).
+
+    on_line, if given, is called with every output line as it arrives, and on_start with
+    the process once it is running. With profiling on, the run is recorded under
+    profile_name (default: the program name) for the variant folder holding log_path. Raises
+    CalledProcessError on a non-zero exit, with the last tail_lines lines as stderr, and
+    returns those lines otherwise.
+    """
+    handler = logging.handlers.RotatingFileHandler(
+        log_path, maxBytes=log_max_bytes, backupCount=log_backups, encoding="utf-8"
+    )
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    tail = collections.deque(maxlen=tail_lines)
+    try:
+        profile_fields = {"name": profile_name, "variant": os.path.basename(os.path.dirname(os.path.abspath(log_path)))}
+        with profiling.popen(
+            cmd, profile_fields, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            text=True, errors="replace", bufsize=1
+        ) as proc:
+            if on_start is not None:
+                on_start(proc)
+            for line in proc.stdout:
+                line = line.rstrip("\n")
+                tail.append(line)
+                handler.handle(logging.makeLogRecord({"msg": line, "levelno": logging.INFO}))
+                if on_line is not None:
+                    on_line(line)
+            returncode = profiling.wait(proc)
+    finally:
+        handler.close()
+
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd, stderr="\n".join(tail))
+    return list(tail)
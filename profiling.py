@@ -0,0 +1,235 @@
+"""Optional resource-usage records for stages, Python hot paths and external tools.
+
+Nothing is recorded unless DOCKING_PROFILE names a report file; pipeline.py --profile sets
+it for every stage it starts. Each record is one JSON line appended to that file:
+
+    kind        "stage" (a whole script), "span" (a Python step such as check_log or
+                parse_rnk) or "subprocess" (gmx, gold_utils, gold_auto, ...)
+    name        stage, step or program name; variant when it concerns one variant
+    wall_s      wall time; queued_s as well where the caller knows how long it waited
+    cpu_user_s, cpu_sys_s
+                CPU time: of the child for subprocesses (from os.wait4), of the calling
+                thread for spans, of the process and its children for stages
+    maxrss_kb   peak resident memory of the child or process
+    read_bytes, write_bytes
+                for subprocesses, block I/O from rusage (page-cache hits are not counted);
+                for stages and spans, bytes passed through read()/write() by the process
+                or the calling thread (/proc/self/io, /proc/thread-self/io)
+
+    python profiling.py report.jsonl           # where the time went, by stage and step
+
+With DOCKING_CPROFILE=<dir> as well, each stage also writes a cProfile dump of its main
+thread to <dir>/<stage>.<pid>.prof (work done in thread pools is not included).
+"""
+import argparse
+import contextlib
+import cProfile
+import json
+import os
+import resource
+import socket
+import subprocess
+import threading
+import time
+
+report_env = "DOCKING_PROFILE"
+cprofile_env = "DOCKING_CPROFILE"
+
+_write_lock = threading.Lock()
+_thread_usage = getattr(resource, "RUSAGE_THREAD", resource.RUSAGE_SELF)
+
+
+def enabled():
+    return bool(os.environ.get(report_env))
+
+
+def record(kind, name, **fields):
+    path = os.environ.get(report_env)
+    if not path:
+        return
+    entry = dict(kind=kind, name=name, host=socket.gethostname(), pid=os.getpid(), **fields)
+    line = json.dumps(entry, sort_keys=True) + "\n"
+    # One write per record, so lines from concurrent stages do not interleave.
+    with _write_lock:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode())
+        finally:
+            os.close(fd)
+
+
+def _io_counters(source="/proc/self/io"):
+    try:
+        with open(source, "r") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _delta(after, before):
+    return after - before if after is not None and before is not None else None
+
+
+@contextlib.contextmanager
+def span(name, kind="span", who=_thread_usage, **fields):
+    """Record the wall time, CPU time and I/O of the enclosed block."""
+    if not enabled():
+        yield
+        return
+    usage = resource.getrusage(who)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN) if kind == "stage" else None
+    # Spans may run in pool threads; count only the calling thread's I/O where Linux allows.
+    io_source = "/proc/self/io" if kind == "stage" or not os.path.exists("/proc/thread-self/io") else "/proc/thread-self/io"
+    read, written = _io_counters(io_source)
+    start, wall = time.time(), time.perf_counter()
+    try:
+        yield
+    finally:
+        end_usage = resource.getrusage(who)
+        user = end_usage.ru_utime - usage.ru_utime
+        system = end_usage.ru_stime - usage.ru_stime
+        maxrss = end_usage.ru_maxrss
+        if children is not None:
+            end_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            user += end_children.ru_utime - children.ru_utime
+            system += end_children.ru_stime - children.ru_stime
+            maxrss = max(maxrss, end_children.ru_maxrss)
+        end_read, end_written = _io_counters(io_source)
+        record(kind, name, start=start, wall_s=round(time.perf_counter() - wall, 6),
+               cpu_user_s=round(user, 6), cpu_sys_s=round(system, 6), maxrss_kb=maxrss,
+               read_bytes=_delta(end_read, read), write_bytes=_delta(end_written, written), **fields)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Wrap a whole script; also writes a cProfile dump when DOCKING_CPROFILE is set."""
+    profile_dir = os.environ.get(cprofile_env)
+    profiler = cProfile.Profile() if profile_dir else None
+    with span(name, kind="stage", who=resource.RUSAGE_SELF):
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                os.makedirs(profile_dir, exist_ok=True)
+                profiler.dump_stats(os.path.join(profile_dir, f"{name}.{os.getpid()}.prof"))
+
+
+def _finish(proc, status, usage):
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    started, perf_started, fields = proc._profile
+    fields = dict(fields)
+    program = proc.args[0] if isinstance(proc.args, (list, tuple)) else proc.args
+    name = fields.pop("name", None) or os.path.basename(str(program))
+    record("subprocess", name, start=started, wall_s=round(time.perf_counter() - perf_started, 6),
+           cpu_user_s=round(usage.ru_utime, 6), cpu_sys_s=round(usage.ru_stime, 6),
+           maxrss_kb=usage.ru_maxrss, read_bytes=usage.ru_inblock * 512, write_bytes=usage.ru_oublock * 512,
+           returncode=proc.returncode, **fields)
+    return proc.returncode
+
+
+def popen(args, profile_fields=None, **kwargs):
+    """subprocess.Popen whose child is accounted for by wait()/poll().
+
+    profile_fields are added to the record (e.g. variant); "name" replaces the program name.
+    """
+    proc = subprocess.Popen(args, **kwargs)
+    proc._profile = (time.time(), time.perf_counter(), profile_fields or {})
+    return proc
+
+
+def _accounted(proc):
+    return enabled() and proc.returncode is None and hasattr(proc, "_profile")
+
+
+def wait(proc):
+    """proc.wait(), reaping the child with os.wait4 to record its resource usage."""
+    if not _accounted(proc):
+        return proc.wait()
+    try:
+        _, status, usage = os.wait4(proc.pid, 0)
+    except ChildProcessError:
+        return proc.wait()
+    return _finish(proc, status, usage)
+
+
+def poll(proc):
+    """proc.poll() with the same accounting as wait()."""
+    if not _accounted(proc):
+        return proc.poll()
+    try:
+        pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+    except ChildProcessError:
+        return proc.poll()
+    if pid == 0:
+        return None
+    return _finish(proc, status, usage)
+
+
+def run(args, check=False, profile_fields=None, **kwargs):
+    """subprocess.run for commands whose output is redirected (no capture or timeout)."""
+    proc = popen(args, profile_fields, **kwargs)
+    try:
+        returncode = wait(proc)
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    if check and returncode != 0:
+        raise subprocess.CalledProcessError(returncode, args)
+    return subprocess.CompletedProcess(args, returncode)
+
+
+def load(path):
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize(records):
+    """Rows of (kind, name, count, wall, cpu, p50, p95, max rss, read, written, queued), by total wall time."""
+    groups = {}
+    for r in records:
+        groups.setdefault((r["kind"], r["name"]), []).append(r)
+    rows = []
+    for (kind, name), group in groups.items():
+        walls = sorted(r["wall_s"] for r in group)
+        rows.append((
+            kind, name, len(group), sum(walls),
+            sum(r.get("cpu_user_s", 0) + r.get("cpu_sys_s", 0) for r in group),
+            walls[len(walls) // 2], walls[min(len(walls) - 1, int(len(walls) * 0.95))],
+            max(r.get("maxrss_kb") or 0 for r in group),
+            sum(r.get("read_bytes") or 0 for r in group),
+            sum(r.get("write_bytes") or 0 for r in group),
+            sum(r.get("queued_s") or 0 for r in group),
+        ))
+    return sorted(rows, key=lambda row: (row[0] != "stage", -row[3]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize a DOCKING_PROFILE report.")
+    parser.add_argument("report")
+    parser.add_argument("--top", type=int, default=10, help="Also list the N slowest variants.")
+    args = parser.parse_args()
+
+    records = load(args.report)
+    print(f"{'Kind':<11} {'Name':<28} {'Count':>6} {'Wall (s)':>10} {'CPU (s)':>9} {'p50 (s)':>8} "
+          f"{'p95 (s)':>8} {'Max RSS MB':>10} {'Read MB':>8} {'Write MB':>8} {'Queued (s)':>10}")
+    for kind, name, count, wall, cpu, p50, p95, rss, read, written, queued in summarize(records):
+        print(f"{kind:<11} {name:<28} {count:>6} {wall:>10.2f} {cpu:>9.2f} {p50:>8.3f} {p95:>8.3f} "
+              f"{rss / 1024:>10.1f} {read / 1e6:>8.1f} {written / 1e6:>8.1f} {queued:>10.1f}")
+
+    per_variant = {}
+    for r in records:
+        if r.get("variant") and r["kind"] != "stage":
+            per_variant[r["variant"]] = per_variant.get(r["variant"], 0.0) + r["wall_s"]
+    if per_variant and args.top:
+        print("\nSlowest variants (wall time of their steps and tools):")
+        for variant, wall in sorted(per_variant.items(), key=lambda kv: -kv[1])[:args.top]:
+            print(f"  {variant:<40} {wall:>10.2f} s")
+
+
+if __name__ == "__main__":
+    main()
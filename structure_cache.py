@@ -0,0 +1,144 @@
+"""Parse-once cache of variant structures as memory-mapped NumPy arrays.
+
+The first load of a PDB or GRO file parses it (waters skipped, as in load_pdb) and stores
+the atoms next to the source, in a hidden folder named after it:
+
+    .EM_Variant1_monomer.pdb.npycache/
+        coords.npy      float32 (n, 3), in Å (GRO nm are converted)
+        name.npy, resn.npy, chain.npy, resi.npy
+                        int32 indices into the vocabularies of meta.json
+        hetatm.npy      bool (always False for GRO, which has no HETATM records)
+        res_index.npy   int32 residue number of every atom, as Structure computes it
+        meta.json       size and mtime of the source, vocabularies
+
+Later loads memory-map the arrays instead of reading the text again; the cache is rebuilt
+whenever the size or mtime of the source changes. Only the small string columns are
+materialized from their vocabularies.
+
+    python structure_cache.py monomers/Variant*/EM_Variant*_monomer.pdb   # build ahead of time
+"""
+import argparse
+import json
+import os
+import shutil
+
+import numpy as np
+
+from pocket_geometry import Structure, load_pdb, water_resn
+
+cache_version = 1
+# GROMACS names its waters SOL as well.
+gro_water_resn = water_resn + ("SOL",)
+label_columns = ("name", "resn", "chain", "resi")
+
+
+def cache_path(path):
+    head, tail = os.path.split(os.path.abspath(path))
+    return os.path.join(head, f".{tail}.npycache")
+
+
+def load_gro(path):
+    """Read a GRO file, skipping waters; coordinates are converted from nm to Å."""
+    with open(path, "r") as f:
+        f.readline()
+        n_atoms = int(f.readline())
+        lines = [f.readline() for _ in range(n_atoms)]
+    # The coordinate fields are 8 wide by default, wider when written with more decimals.
+    first = lines[0][20:] if lines else ""
+    dots = [i for i, c in enumerate(first) if c == "."][:2]
+    width = dots[1] - dots[0] if len(dots) == 2 else 8
+
+    coords, name, resn, resi = [], [], [], []
+    for line in lines:
+        residue = line[5:10].strip()
+        if residue in gro_water_resn:
+            continue
+        coords.append(tuple(float(line[20 + k * width:20 + (k + 1) * width]) * 10.0 for k in range(3)))
+        name.append(line[10:15].strip())
+        resn.append(residue)
+        resi.append(line[0:5].strip())
+    return Structure(
+        np.array(coords, dtype=float).reshape(-1, 3),
+        np.array(name, dtype=str),
+        np.array(resn, dtype=str),
+        np.full(len(name), "", dtype=str),
+        np.array(resi, dtype=str),
+        np.zeros(len(name), dtype=bool),
+    )
+
+
+def parse(path):
+    return load_gro(path) if path.lower().endswith(".gro") else load_pdb(path)
+
+
+def _source_stamp(path):
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "version": cache_version}
+
+
+def _read(cache, stamp):
+    try:
+        with open(os.path.join(cache, "meta.json"), "r") as f:
+            meta = json.load(f)
+        if meta.get("source") != stamp:
+            return None
+        arrays = {key: np.load(os.path.join(cache, f"{key}.npy"), mmap_mode="r")
+                  for key in ("coords", "hetatm", "res_index") + label_columns}
+    except (OSError, ValueError):
+        return None
+    labels = [np.array(meta["vocab"][key], dtype=str)[arrays[key]] for key in label_columns]
+    return Structure(arrays["coords"], *labels, arrays["hetatm"], res_index=arrays["res_index"])
+
+
+def _write(cache, struct, stamp):
+    tmp = f"{cache}.{os.getpid()}.tmp"
+    os.makedirs(tmp, exist_ok=True)
+    meta = {"source": stamp, "vocab": {}}
+    np.save(os.path.join(tmp, "coords.npy"), np.asarray(struct.coords, dtype=np.float32))
+    np.save(os.path.join(tmp, "hetatm.npy"), np.asarray(struct.hetatm, dtype=bool))
+    np.save(os.path.join(tmp, "res_index.npy"), np.asarray(struct.res_index, dtype=np.int32))
+    for key in label_columns:
+        vocab, idx = np.unique(getattr(struct, key), return_inverse=True)
+        meta["vocab"][key] = vocab.tolist()
+        np.save(os.path.join(tmp, f"{key}.npy"), idx.astype(np.int32))
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+    shutil.rmtree(cache, ignore_errors=True)
+    try:
+        os.rename(tmp, cache)
+    except OSError:
+        # Another process put its copy in place first; theirs is just as good.
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def load_structure(path):
+    """Structure of a PDB or GRO file, from its cache when the source has not changed."""
+    cache = cache_path(path)
+    stamp = _source_stamp(path)
+    struct = _read(cache, stamp)
+    if struct is not None:
+        return struct
+    struct = parse(path)
+    try:
+        _write(cache, struct, stamp)
+    except OSError as e:
+        print(f"[WARNING] Could not cache {path}: {e}")
+        return struct
+    # Load back through the cache so both paths hand out the same float32 arrays.
+    cached = _read(cache, stamp)
+    return cached if cached is not None else struct
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the array cache of PDB/GRO structures.")
+    parser.add_argument("files", nargs="+")
+    args = parser.parse_args()
+
+    for path in args.files:
+        struct = load_structure(path)
+        print(f"🧊 {path}: {len(struct)} atoms cached in {cache_path(path)}")
+
+
+if __name__ == "__main__":
+    main()